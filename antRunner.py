@@ -0,0 +1,73 @@
+# Running ant for the jar/war targets
+# Targets that have to run in order go to a single ant process (one JVM start, one parse of build.xml), independent
+# groups of targets run as separate ant processes from the deploy's task graph. Per target wall time is taken from
+# ant's "<target>:" header lines, so a target's time runs from its header to the next selected target's header (or
+# the end of the process).
+
+import re
+import subprocess
+import sys
+import threading
+import time
+
+ANT_TARGET_HEADER = re.compile(r'^([\w.\-]+):\s*$')
+output_lock = threading.Lock()
+
+
+def antCommand(targets, xml_path, ant_cmd='ant'):
+	return [ant_cmd] + list(targets) + ['-f', xml_path]
+
+
+def runAntInvocation(targets, xml_path, ant_cmd='ant'):
+	'''
+	:param targets: ant targets to run in one ant process, in order
+	:return: dictionary mapping each target to {'exit_code': int or None if it never ran, 'seconds': float or None}
+	'''
+	results = {}
+	for target in targets:
+		results[target] = {'exit_code': None, 'seconds': None}
+	prefix = '[{}] '.format(' '.join(targets))
+	current = None
+	started = time.monotonic()
+	target_started = started
+
+	try:
+		proc = subprocess.Popen(antCommand(targets, xml_path, ant_cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+								universal_newlines=True, bufsize=1)
+	except OSError as e:
+		print('{}could not start ant: {}'.format(prefix, e))
+		for target in targets:
+			results[target]['exit_code'] = 127
+		return results
+
+	for line in proc.stdout:
+		with output_lock:
+			sys.stdout.write(prefix + line)
+		m = ANT_TARGET_HEADER.match(line)
+		if m and m.group(1) in results and m.group(1) != current:
+			now = time.monotonic()
+			if current is not None:
+				results[current]['exit_code'] = 0
+				results[current]['seconds'] = now - target_started
+			current = m.group(1)
+			target_started = now
+	exit_code = proc.wait()
+	finished = time.monotonic()
+
+	if current is None:
+		# No header seen (i.e. ant -q or it failed while parsing build.xml), the whole run counts for every target
+		for target in targets:
+			results[target]['exit_code'] = exit_code
+		if len(targets) == 1:
+			results[targets[0]]['seconds'] = finished - started
+		return results
+
+	results[current]['exit_code'] = exit_code
+	results[current]['seconds'] = finished - target_started
+	if exit_code == 0:
+		# Targets ant ran without printing a header of their own (already run as a dependency) still succeeded
+		for target in targets:
+			if results[target]['exit_code'] is None:
+				results[target]['exit_code'] = 0
+	return results
+
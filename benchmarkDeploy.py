@@ -0,0 +1,337 @@
+# Benchmarks of the deploy steps on generated data, no app VM or CodeCloud needed
+# For each scale a git repo is generated with the layout of aotx_azure (site_agnostic/<jar src dir>,
+# site_specific/<branch>, site_specific/jars) and a target commit with a set number of added, modified, renamed and
+# deleted site files, published as the remote branch. Next to it an /opt/app style dst tree is generated: the
+# deployed site files, filler files and every jar/war repeated at several depths.
+# The steps of deployCode.py are then timed on it, each one `repeat` times:
+#   git_diff / iter_git_changes                      the legacy DiffIndex and the streamed raw diff
+#   prepare_to_deploy_changes / iter_deploy_pairs    legacy and streamed src -> dst rewrite
+#   deploy_changes_for_A_or_M / _R / _D              placement through the PlacementExecutor
+#   deploy_branch_changes                            the whole streamed diff -> placement pipeline
+#   findPathsToAllJars (full walk, and from the manifest) and replaceOldJARs
+# Everything is generated from a fixed seed, so two runs on the same machine work on the same data. Results are
+# saved as JSON in the results dir, `--compare OLD NEW` lists the steps that got slower.
+# Usage: python benchmarkDeploy.py [--scale small medium] [--repeat 5]
+#        python benchmarkDeploy.py --compare bench_results/OLD.json bench_results/NEW.json
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from git import Repo
+import deployCode
+from copyEngine import FileCopier, PlacementExecutor
+
+BENCH_WORK_DIR = 'bench_work' # generated repos and app trees, one subdir per scale
+BENCH_RESULTS_DIR = 'bench_results'
+BENCH_SEED = 20211008
+BENCH_REPEAT = 3
+BENCH_BRANCH = 'main'
+REGRESSION_THRESHOLD = 1.10 # --compare flags a step whose median got this much slower
+# changes: number of each of A, M, R and D. app_files: filler files in the dst tree besides the deployed site files.
+# jar_depths: how many nested dirs of the dst tree hold a copy of every jar/war.
+SCALES = {
+	'small': {'repo_files': 1000, 'changes': 100, 'app_files': 2000, 'jars': 8, 'jar_depths': 3, 'file_size': 4 * 1024, 'jar_size': 256 * 1024},
+	'medium': {'repo_files': 10000, 'changes': 1000, 'app_files': 20000, 'jars': 16, 'jar_depths': 5, 'file_size': 4 * 1024, 'jar_size': 1024 * 1024},
+	'large': {'repo_files': 50000, 'changes': 5000, 'app_files': 100000, 'jars': 32, 'jar_depths': 8, 'file_size': 4 * 1024, 'jar_size': 4 * 1024 * 1024},
+}
+
+logger = logging.getLogger('benchmarkDeploy')
+
+
+def writeFile(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'wb') as f:
+		f.write(data)
+
+
+def siteFilePath(i):
+	return 'site_specific/{}/opt/app/d{:03d}/f{:06d}.txt'.format(BENCH_BRANCH, i // 100, i)
+
+
+def makeSyntheticRepo(repo_dir, scale, rng):
+	'''
+	:return: (Repo, base commit SHA, target commit SHA). HEAD is left at base, refs/remotes/origin/<branch> on target.
+	'''
+	repo = Repo.init(repo_dir, initial_branch=BENCH_BRANCH)
+	with repo.config_writer() as cw:
+		cw.set_value('user', 'name', 'benchmark')
+		cw.set_value('user', 'email', 'benchmark@localhost')
+	for i in range(scale['repo_files']):
+		writeFile(os.path.join(repo_dir, siteFilePath(i)), rng.randbytes(scale['file_size']))
+	for target in deployCode.JAR_SRC_DIRNAMES:
+		for i in range(10):
+			writeFile(os.path.join(repo_dir, 'site_agnostic', target, 'src', 'C{}.java'.format(i)), rng.randbytes(1024))
+	writeFile(os.path.join(repo_dir, 'site_agnostic', 'build.xml'), b'<project/>\n')
+	for i in range(scale['jars']):
+		writeFile(os.path.join(repo_dir, 'site_specific', 'jars', 'bench{:02d}.{}'.format(i, 'war' if i == 0 else 'jar')),
+			rng.randbytes(scale['jar_size']))
+	repo.git.add('-A')
+	repo.git.commit('-q', '-m', 'base')
+	base = repo.head.commit.hexsha
+
+	n = scale['changes']
+	picked = rng.sample(range(scale['repo_files']), 3 * n)
+	modified, renamed, deleted = picked[:n], picked[n:2 * n], picked[2 * n:]
+	for i in range(n):
+		writeFile(os.path.join(repo_dir, 'site_specific', BENCH_BRANCH, 'opt', 'app', 'new', 'a{:06d}.txt'.format(i)), rng.randbytes(scale['file_size']))
+	for i in modified:
+		writeFile(os.path.join(repo_dir, siteFilePath(i)), rng.randbytes(scale['file_size']))
+	for i in renamed:
+		dst = os.path.join(repo_dir, 'site_specific', BENCH_BRANCH, 'opt', 'app', 'moved', 'r{:06d}.txt'.format(i))
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+		os.rename(os.path.join(repo_dir, siteFilePath(i)), dst)
+	for i in deleted:
+		os.remove(os.path.join(repo_dir, siteFilePath(i)))
+	# One jar source change, so the changes carry ant targets as well
+	writeFile(os.path.join(repo_dir, 'site_agnostic', deployCode.JAR_SRC_DIRNAMES[0], 'src', 'C0.java'), rng.randbytes(1024))
+	repo.git.add('-A')
+	repo.git.commit('-q', '-m', 'target')
+	target = repo.head.commit.hexsha
+
+	repo.git.update_ref('refs/remotes/origin/{}'.format(BENCH_BRANCH), target)
+	repo.git.reset('-q', '--hard', base)
+	return repo, base, target
+
+
+def makeAppTree(app_dir, repo_dir, scale, rng):
+	'''
+	The dst tree as the base commit left it: the site files, filler files and every jar/war at jar_depths depths.
+	:return: number of files in the tree
+	'''
+	site_dir = os.path.join(repo_dir, 'site_specific', BENCH_BRANCH)
+	files = 0
+	for dirpath, dirnames, filenames in os.walk(site_dir):
+		rel = os.path.relpath(dirpath, site_dir)
+		for fname in filenames:
+			dst = os.path.normpath(os.path.join(app_dir, rel, fname))
+			os.makedirs(os.path.dirname(dst), exist_ok=True)
+			shutil.copyfile(os.path.join(dirpath, fname), dst)
+			files += 1
+	for i in range(scale['app_files']):
+		writeFile(os.path.join(app_dir, 'opt', 'app', 'filler', 'd{:03d}'.format(i // 200), 'x{:06d}.dat'.format(i)), rng.randbytes(512))
+		files += 1
+	jar_dir = os.path.join(repo_dir, 'site_specific', 'jars')
+	for depth in range(1, scale['jar_depths'] + 1):
+		lib_dir = os.path.join(app_dir, 'opt', 'app', *['l{}'.format(level) for level in range(depth)], 'lib')
+		os.makedirs(lib_dir, exist_ok=True)
+		for fname in os.listdir(jar_dir):
+			writeFile(os.path.join(lib_dir, fname), b'old ' + fname.encode())
+			files += 1
+	return files
+
+
+def timeRuns(fn, repeat, setup=None):
+	'''
+	:param setup: called before every run, not timed
+	:return: (dictionary with the seconds of every run, min and median, result of the last run)
+	'''
+	runs = []
+	result = None
+	for _ in range(repeat):
+		if setup is not None:
+			setup()
+		# The legacy functions print every path, that isn't part of what is measured
+		with redirect_stdout(io.StringIO()):
+			started = time.perf_counter()
+			result = fn()
+			runs.append(time.perf_counter() - started)
+	return {'runs': runs, 'min': min(runs), 'median': statistics.median(runs)}, result
+
+
+def newExecutor():
+	# Every file is written, a hash cache from an earlier run would turn copies into skips
+	copier = FileCopier(skip_unchanged=False, strategies=deployCode.PLACEMENT_STRATEGIES, delta_min_size=deployCode.DELTA_MIN_SIZE)
+	return PlacementExecutor(max_workers=deployCode.COPY_WORKERS, copier=copier)
+
+
+def benchmarkScale(name, scale, work_dir, repeat, seed=BENCH_SEED):
+	'''
+	:return: dictionary with the scale's settings, how long generating took and every step's timings
+	'''
+	rng = random.Random('{}:{}'.format(seed, name))
+	scale_dir = os.path.abspath(os.path.join(work_dir, name))
+	if os.path.exists(scale_dir):
+		shutil.rmtree(scale_dir)
+	repo_dir = os.path.join(scale_dir, 'repo')
+	app_dir = os.path.join(scale_dir, 'app')
+	os.makedirs(app_dir)
+	app_root = app_dir + '/'
+
+	started = time.perf_counter()
+	repo, base, target = makeSyntheticRepo(repo_dir, scale, rng)
+	app_files = makeAppTree(app_dir, repo_dir, scale, rng)
+	generated = time.perf_counter() - started
+	logger.info('{}: generated {} repo files and {} app files in {:.1f}s'.format(name, scale['repo_files'], app_files, generated))
+
+	steps = {}
+	def step(step_name, fn, setup=None, items=None):
+		steps[step_name], result = timeRuns(fn, repeat, setup)
+		if items is not None:
+			steps[step_name]['items'] = items(result)
+		logger.info('{}: {} {:.3f}s'.format(name, step_name, steps[step_name]['median']))
+		return result
+
+	rmt_branch = 'origin/{}'.format(BENCH_BRANCH)
+	# Diff and path rewrite, with HEAD still on the deployed commit like before the merge
+	diff_data = step('git_diff', lambda: deployCode.git_diff(repo, 'origin', BENCH_BRANCH, scale_dir)[1],
+		items=lambda d: sum(len(v) for v in d.values()))
+	step('prepare_to_deploy_changes', lambda: deployCode.prepare_to_deploy_changes(diff_data, dst_root=app_root, gitdir=repo_dir, branch_name=BENCH_BRANCH),
+		items=lambda pairs: sum(len(v) for v in pairs.values()))
+	step('iter_git_changes', lambda: sum(1 for _ in deployCode.iter_git_changes(repo, base, target)), items=lambda n: n)
+	deploy_pairs = step('iter_deploy_pairs', lambda: list(deployCode.iter_deploy_pairs(deployCode.iter_git_changes(repo, base, target),
+		dst_root=app_root, gitdir=repo_dir, branch_name=BENCH_BRANCH)), items=len)
+
+	repo.git.merge('-q', '--ff-only', rmt_branch)
+	src_dst = {'A': [], 'M': [], 'R': [], 'D': []}
+	for letter, src, dst in deploy_pairs:
+		src_dst[letter].append((src, dst))
+
+	# Placement, each run starts from the dst tree as the base commit left it
+	placeholder = b'\0' * scale['file_size']
+	executor = [None]
+	def fresh(reset):
+		def setup():
+			reset()
+			executor[0] = newExecutor()
+		return setup
+	def placed(deploy):
+		def run():
+			deploy(executor[0])
+			executor[0].shutdown()
+			if executor[0].failure_count:
+				# Timings of failed ops would only measure the error path
+				raise RuntimeError('{} placements failed: {}'.format(executor[0].failure_count, executor[0].failures[:3]))
+		return run
+
+	def resetAdded():
+		for src, dst in src_dst['A']:
+			if os.path.exists(dst):
+				os.remove(dst)
+	def resetRenamed():
+		for src, dst in src_dst['R']:
+			if os.path.exists(dst):
+				os.remove(dst)
+			writeFile(src, placeholder)
+	def resetDeleted():
+		for src, dst in src_dst['D']:
+			writeFile(dst, placeholder)
+
+	step('deploy_changes_for_A', placed(lambda ex: deployCode.deploy_changes_for_A_or_M(src_dst, 'A', executor=ex)),
+		setup=fresh(resetAdded), items=lambda _: len(src_dst['A']))
+	step('deploy_changes_for_M', placed(lambda ex: deployCode.deploy_changes_for_A_or_M(src_dst, 'M', executor=ex)),
+		setup=fresh(lambda: None), items=lambda _: len(src_dst['M']))
+	step('deploy_changes_for_R', placed(lambda ex: deployCode.deploy_changes_for_R(src_dst, executor=ex)),
+		setup=fresh(resetRenamed), items=lambda _: len(src_dst['R']))
+	step('deploy_changes_for_D', placed(lambda ex: deployCode.deploy_changes_for_D(src_dst, executor=ex)),
+		setup=fresh(resetDeleted), items=lambda _: len(src_dst['D']))
+
+	def resetAll():
+		resetAdded()
+		resetRenamed()
+		resetDeleted()
+	step('deploy_branch_changes', placed(lambda ex: deployCode.deploy_branch_changes(repo, base, target, None, executor=ex,
+		dst_root=app_root, gitdir=repo_dir, branch_name=BENCH_BRANCH)), setup=fresh(resetAll), items=lambda _: len(deploy_pairs))
+
+	# Jar search and fan-out over the dst tree
+	jar_src_paths = deployCode.getJarFilesFullSrcPaths(os.path.join(repo_dir, 'site_specific', 'jars'))
+	jar_names = [os.path.basename(p) for p in jar_src_paths]
+	deployCode.JAR_MANIFEST_PATH = os.path.join(scale_dir, 'jar_locations_manifest.json')
+	count_dsts = lambda found: sum(len(dsts) for dsts in found.values())
+	step('findPathsToAllJars_walk', lambda: deployCode.findPathsToAllJars(jar_names, rootdir=app_dir, rescan=True), items=count_dsts)
+	step('findPathsToAllJars_manifest', lambda: deployCode.findPathsToAllJars(jar_names, rootdir=app_dir), items=count_dsts)
+	step('replaceOldJARs', placed(lambda ex: deployCode.replaceOldJARs(jar_src_paths, rootdir=app_dir, executor=ex)),
+		setup=fresh(lambda: None), items=lambda _: len(jar_names) * scale['jar_depths'])
+
+	return {'settings': scale, 'generate_seconds': generated, 'app_files': app_files, 'steps': steps}
+
+
+def codeVersion():
+	try:
+		return Repo(os.path.dirname(os.path.abspath(__file__))).head.commit.hexsha
+	except Exception:
+		return None
+
+
+def runBenchmarks(scale_names, work_dir=BENCH_WORK_DIR, results_dir=BENCH_RESULTS_DIR, repeat=BENCH_REPEAT, seed=BENCH_SEED, keep=False):
+	'''
+	:param keep: leave the generated repos and app trees in work_dir
+	:return: path of the saved results
+	'''
+	results = {
+		'created': time.time(),
+		'commit': codeVersion(),
+		'seed': seed,
+		'repeat': repeat,
+		'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+		'config': {'COPY_WORKERS': deployCode.COPY_WORKERS, 'PLACEMENT_STRATEGIES': deployCode.PLACEMENT_STRATEGIES},
+		'scales': {},
+	}
+	for name in scale_names:
+		results['scales'][name] = benchmarkScale(name, SCALES[name], work_dir, repeat, seed=seed)
+		if not keep:
+			shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+
+	os.makedirs(results_dir, exist_ok=True)
+	path = os.path.join(results_dir, 'bench_{}_{}.json'.format(datetime.utcnow().strftime('%Y%m%d%H%M%S'), (results['commit'] or 'unknown')[:12]))
+	with open(path, 'w') as f:
+		json.dump(results, f, indent=1)
+	return path
+
+
+def compareResults(old_path, new_path, threshold=REGRESSION_THRESHOLD):
+	'''
+	Prints the median of every step both runs have, old vs new.
+	:return: list of (scale, step) that got slower than threshold allows
+	'''
+	with open(old_path) as f:
+		old = json.load(f)
+	with open(new_path) as f:
+		new = json.load(f)
+	if old['machine'] != new['machine']:
+		print('warning: the runs are from different machines, {} vs {}'.format(old['machine'], new['machine']))
+	regressions = []
+	for scale in new['scales']:
+		if scale not in old['scales']:
+			continue
+		print('{}:'.format(scale))
+		for step_name, timing in new['scales'][scale]['steps'].items():
+			before = old['scales'][scale]['steps'].get(step_name)
+			if before is None:
+				continue
+			ratio = timing['median'] / before['median'] if before['median'] > 0 else float('inf')
+			slower = ratio > threshold
+			if slower:
+				regressions.append((scale, step_name))
+			print('  {:<30} {:>9.4f}s -> {:>9.4f}s  x{:.2f}{}'.format(step_name, before['median'], timing['median'], ratio, '  SLOWER' if slower else ''))
+	return regressions
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--scale', nargs='*', choices=sorted(SCALES), default=['small'], help='scales to run (small by default)')
+	parser.add_argument('--repeat', type=int, default=BENCH_REPEAT, help='runs of every step, the median is compared')
+	parser.add_argument('--work-dir', default=BENCH_WORK_DIR)
+	parser.add_argument('--results-dir', default=BENCH_RESULTS_DIR)
+	parser.add_argument('--seed', type=int, default=BENCH_SEED)
+	parser.add_argument('--keep', action='store_true', help='keep the generated repos and app trees')
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results, exit 1 when a step got slower')
+	args = parser.parse_args()
+	logging.basicConfig(format='%(message)s')
+	logger.setLevel(logging.INFO)
+	# deployCode's own logging stays quiet, it would mostly measure the terminal
+	deployCode.VERBOSE = False
+
+	if args.compare:
+		sys.exit(1 if compareResults(*args.compare) else 0)
+	print('results saved to {}'.format(runBenchmarks(args.scale, work_dir=args.work_dir, results_dir=args.results_dir,
+		repeat=args.repeat, seed=args.seed, keep=args.keep)))
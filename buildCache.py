@@ -0,0 +1,116 @@
+# Local cache of the .jar/.war files produced by ant, keyed by the source they were built from
+# The key is the git tree SHAs of the target's source dirs (every dir pathClassifier maps to the target, i.e.
+# site_agnostic/<target> and site_specific/<target>) plus the blob SHA of build.xml, so the same commit built on
+# another regional VM (or rebuilt after an unrelated change) maps to the same entry. On a hit the artifacts are
+# copied back into the jar dir and ant isn't run at all.
+# Entries are evicted least recently used first once the cache is over max_bytes.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+
+class BuildCache:
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.index_path = os.path.join(cache_dir, 'index.json')
+		self.hits = 0
+		self.misses = 0
+		os.makedirs(cache_dir, exist_ok=True)
+		try:
+			with open(self.index_path) as f:
+				self.index = json.load(f)
+		except (OSError, ValueError):
+			self.index = {'entries': {}, 'hits': 0, 'misses': 0}
+
+	def key(self, repo, target, src_parents, build_xml_path):
+		'''
+		:param src_parents: repo relative dirs holding jar source dirs, i.e. ('site_agnostic', 'site_specific')
+		:param build_xml_path: repo relative path to build.xml
+		:return: cache key for target at the repo's HEAD, or None if none of its source dirs is in the tree
+		'''
+		tree = repo.head.commit.tree
+		try:
+			xml_sha = (tree / build_xml_path).hexsha
+		except KeyError:
+			return None
+		src_shas = []
+		for src_parent in src_parents:
+			try:
+				src_shas.append((tree / '{}/{}'.format(src_parent, target)).hexsha)
+			except KeyError:
+				# Adding the dir later changes the key too
+				src_shas.append('-')
+		if all(sha == '-' for sha in src_shas):
+			return None
+		return hashlib.sha256('{}:{}:{}'.format(target, ':'.join(src_shas), xml_sha).encode()).hexdigest()
+
+	def entryDir(self, key):
+		return os.path.join(self.cache_dir, key)
+
+	def restore(self, key, dst_dir):
+		'''
+		:return: list of restored artifact paths, or None on a miss
+		'''
+		entry = self.index['entries'].get(key)
+		if entry is None:
+			self.misses += 1
+			self.index['misses'] += 1
+			return None
+
+		restored = []
+		try:
+			for fname in entry['files']:
+				restored.append(shutil.copy2(os.path.join(self.entryDir(key), fname), os.path.join(dst_dir, fname)))
+		except OSError:
+			# Entry got damaged on disk, drop it and build instead
+			self.drop(key)
+			self.misses += 1
+			self.index['misses'] += 1
+			return None
+
+		entry['last_used'] = time.time()
+		self.hits += 1
+		self.index['hits'] += 1
+		return restored
+
+	def store(self, key, artifact_paths):
+		if not artifact_paths:
+			return
+		entry_dir = self.entryDir(key)
+		os.makedirs(entry_dir, exist_ok=True)
+		files = []
+		size = 0
+		for apath in artifact_paths:
+			fname = os.path.basename(apath)
+			shutil.copy2(apath, os.path.join(entry_dir, fname))
+			files.append(fname)
+			size += os.path.getsize(apath)
+		self.index['entries'][key] = {'files': files, 'size': size, 'last_used': time.time()}
+		self.evict()
+
+	def drop(self, key):
+		self.index['entries'].pop(key, None)
+		shutil.rmtree(self.entryDir(key), ignore_errors=True)
+
+	def evict(self):
+		entries = self.index['entries']
+		total = sum(e['size'] for e in entries.values())
+		for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+			if total <= self.max_bytes:
+				break
+			total -= entries[key]['size']
+			self.drop(key)
+
+	def save(self):
+		tmp_path = self.index_path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self.index, f)
+		os.replace(tmp_path, self.index_path)
+
+	def report(self):
+		return 'Build cache: {} hits, {} misses this run ({} hits, {} misses total)'.format(
+			self.hits, self.misses, self.index['hits'], self.index['misses'])
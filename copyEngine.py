@@ -0,0 +1,629 @@
+# Copying files from the git repo onto the app VM
+# Used by deployCode.py (A/M changes and jar fan-out) and updateJars.py (jar fan-out).
+# With skip_unchanged, a destination that already holds the same bytes is left alone:
+#  1. different size -> copy
+#  2. same size and same mtime -> skip (copies made here carry the source mtime, see shutil.copy2)
+#  3. same size, different mtime -> compare content hashes. Hashes are cached on disk keyed by
+#     (device, inode, size, mtime, ctime) so a file is only read again once it actually changed. ctime is in the
+#     key because it can't be set back with os.utime the way mtime can. Files that are only ever replaced, never
+#     written in place (staged releases, hardlinked release store objects) are keyed without ctime: every new
+#     hardlink to them bumps it, which would hash them again on each staged deploy.
+#     Each entry remembers the last run (save) that looked it up, entries unused for HASH_CACHE_KEEP_RUNS runs are
+#     dropped when saving, so replaced files don't pile up in the cache file.
+#
+# How the bytes get to a destination is configurable (placement strategies, tried in order until one works):
+#  reflink          - FICLONE ioctl, the destination shares the source's blocks (btrfs, XFS with reflink=1)
+#  copy_file_range  - in-kernel copy, no round trip through user space
+#  sendfile         - in-kernel copy, works across filesystems on older kernels
+#  hardlink         - every destination of the same source on one filesystem is linked to the first copy placed there
+#  delta            - for a destination of at least delta_min_size that already exists: rsync style, the blocks of the
+#                     destination are matched in the source with a rolling (adler32) and a strong (blake2b) checksum,
+#                     both files read through mmap. A temp file is built from the matched destination blocks
+#                     (copy_file_range, in kernel) and the changed bytes of the source, then renamed over the
+#                     destination (owned like the destination). Skipped when more than DELTA_MAX_LITERAL_RATIO of
+#                     the source would be new bytes, or less than DELTA_MIN_PROBE_MATCH of its first
+#                     DELTA_PROBE_BLOCKS blocks is found in the destination (new bytes are checksummed one at a time
+#                     in Python, so a mostly new file is better copied in kernel), and for destinations with more
+#                     than one link unless replace_links is set, since the rename would unlink them.
+# shutil.copyfile is always the last resort. The strategy used for each destination is logged at debug level.
+#
+# PlacementExecutor runs the copies/moves/deletes of a deploy on a bounded thread pool. Operations touching the
+# same path still run in the order they were submitted, and failures are collected per file. At most max_pending
+# operations are queued at once, so a stream of changes of any length is placed with flat memory.
+
+import errno
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+COPY_WORKERS = 8
+MAX_PENDING_PER_WORKER = 64
+PLACEMENT_STRATEGIES = ['reflink', 'copy_file_range', 'sendfile']
+FICLONE = 0x40049409 # from linux/fs.h
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+DELTA_MIN_SIZE = 8 * 1024 * 1024
+DELTA_BLOCK_SIZE = 16 * 1024
+DELTA_MAX_LITERAL_RATIO = 0.25 # unmatched bytes are checksummed one at a time, so a mostly new file gives up early
+DELTA_PROBE_BLOCKS = 8 # blocks of the source scanned before deciding whether the delta is worth it
+DELTA_MIN_PROBE_MATCH = 0.5 # share of the probed bytes that has to be found in the destination
+ADLER_MOD = 65521
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_CACHE_VERSION = 2
+HASH_CACHE_KEEP_RUNS = 10 # runs an entry survives without being looked up
+
+
+class HashCache:
+    '''
+    :param path: json file the hashes are kept in between runs (None keeps them in memory only)
+    :param keep_runs: runs (saves) an entry is kept for after its last lookup
+    '''
+    def __init__(self, path=None, keep_runs=HASH_CACHE_KEEP_RUNS):
+        self.path = path
+        self.keep_runs = keep_runs
+        # stat key -> [hexdigest, run that last looked it up]
+        self.hashes = {}
+        self.run = 0
+        self.dirty = False
+        if path is not None:
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+                # Files from before entries carried their last run are dropped, they were never pruned
+                if isinstance(saved, dict) and saved.get('version') == HASH_CACHE_VERSION:
+                    self.hashes = saved['hashes']
+                    self.run = saved['run'] + 1
+            except (OSError, ValueError, KeyError):
+                self.hashes = {}
+
+    def digest(self, path, st, linked=False):
+        '''
+        :param linked: path is hardlinked and never written in place, its content can't change under the same inode
+        '''
+        if linked:
+            key = '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        else:
+            key = '{}:{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        entry = self.hashes.get(key)
+        if entry is not None:
+            if entry[1] != self.run:
+                entry[1] = self.run
+                self.dirty = True
+            return entry[0]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
+        hexdigest = h.hexdigest()
+        self.hashes[key] = [hexdigest, self.run]
+        self.dirty = True
+        return hexdigest
+
+    def save(self):
+        '''
+        Drops the entries no run looked up in the last keep_runs runs and writes the rest. A long running process
+        calling save() after every deploy counts each deploy as a run.
+        '''
+        if self.path is None or not self.dirty:
+            return
+        oldest = self.run - self.keep_runs
+        self.hashes = {key: entry for key, entry in self.hashes.items() if entry[1] > oldest}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': HASH_CACHE_VERSION, 'run': self.run, 'hashes': self.hashes}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        self.run += 1
+
+
+def reflinkFile(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'reflink not supported on this platform')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copyFileRange(src, dst):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'os.copy_file_range not available')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, COPY_CHUNK_SIZE))
+            if sent == 0:
+                # Source shrank or the filesystem won't copy more this way, let the next strategy write dst
+                raise OSError(errno.EIO, 'copy_file_range stopped with {} bytes left'.format(remaining), src)
+            remaining -= sent
+
+
+def sendfileCopy(src, dst):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, 'os.sendfile not available')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, min(remaining, COPY_CHUNK_SIZE))
+            if sent == 0:
+                raise OSError(errno.EIO, 'sendfile stopped with {} bytes left'.format(remaining), src)
+            offset += sent
+            remaining -= sent
+
+
+def hardlinkFile(staged, dst):
+    # Linked under a temp name and renamed over dst so dst is never missing
+    tmp_path = '{}.{}.lnk'.format(dst, threading.get_ident())
+    os.link(staged, tmp_path)
+    try:
+        os.replace(tmp_path, dst)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+def blockSignatures(mm, block_size):
+    # adler32 -> {strong digest: block index} for every full block of mm
+    signatures = {}
+    for index in range(len(mm) // block_size):
+        block = mm[index * block_size:(index + 1) * block_size]
+        strong = hashlib.blake2b(block, digest_size=16).digest()
+        signatures.setdefault(zlib.adler32(block), {}).setdefault(strong, index)
+    return signatures
+
+
+def deltaOps(src_mm, dst_mm, block_size, max_literal, probe_blocks=DELTA_PROBE_BLOCKS, min_probe_match=DELTA_MIN_PROBE_MATCH):
+    '''
+    :return: list of ('copy', dst offset, length) / ('literal', src offset, length) rebuilding src, or None once
+        more than max_literal bytes of src would have to be written as they are, or when less than min_probe_match
+        of the first probe_blocks blocks of src matched
+    '''
+    signatures = blockSignatures(dst_mm, block_size)
+    n = len(src_mm)
+    ops = []
+    literal_start = 0
+    literal_bytes = 0
+    probe_end = probe_blocks * block_size
+    probed = False
+    pos = 0
+    next_index = None
+    weak = zlib.adler32(src_mm[0:block_size]) if n >= block_size else None
+    while pos + block_size <= n:
+        match = None
+        # Same layout as the destination is the common case, a plain compare is enough for it
+        if next_index is not None and (next_index + 1) * block_size <= len(dst_mm) and \
+                src_mm[pos:pos + block_size] == dst_mm[next_index * block_size:(next_index + 1) * block_size]:
+            match = next_index
+        elif weak in signatures:
+            match = signatures[weak].get(hashlib.blake2b(src_mm[pos:pos + block_size], digest_size=16).digest())
+        if match is not None:
+            if literal_start < pos:
+                ops.append(('literal', literal_start, pos - literal_start))
+            if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == match * block_size:
+                ops[-1] = ('copy', ops[-1][1], ops[-1][2] + block_size)
+            else:
+                ops.append(('copy', match * block_size, block_size))
+            pos += block_size
+            literal_start = pos
+            next_index = match + 1
+            if pos + block_size <= n:
+                weak = zlib.adler32(src_mm[pos:pos + block_size])
+            continue
+
+        next_index = None
+        literal_bytes += 1
+        if literal_bytes > max_literal:
+            return None
+        if not probed and pos >= probe_end:
+            probed = True
+            if literal_bytes > (1 - min_probe_match) * pos:
+                return None
+        if pos + block_size < n:
+            # Roll the window one byte forward
+            x_out = src_mm[pos]
+            a = ((weak & 0xffff) - x_out + src_mm[pos + block_size]) % ADLER_MOD
+            b = ((weak >> 16) - block_size * x_out + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+        pos += 1
+    if literal_start < n:
+        ops.append(('literal', literal_start, n - literal_start))
+    return ops
+
+
+def deltaFile(src, dst, block_size=DELTA_BLOCK_SIZE, max_literal_ratio=DELTA_MAX_LITERAL_RATIO):
+    '''
+    Rewrites dst to hold src's bytes, writing only the bytes dst doesn't already have. dst is replaced by rename,
+    the new file gets dst's owner and group.
+    :return: (bytes written from src, bytes reused from dst), or None when the delta isn't worth it (nothing written then)
+    '''
+    tmp_path = '{}.{}.delta'.format(dst, threading.get_ident())
+    with open(src, 'rb') as fsrc, open(dst, 'rb') as fdst:
+        src_size = os.fstat(fsrc.fileno()).st_size
+        dst_st = os.fstat(fdst.fileno())
+        if src_size == 0 or dst_st.st_size < block_size:
+            return None
+        with mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ) as src_mm, \
+                mmap.mmap(fdst.fileno(), 0, access=mmap.ACCESS_READ) as dst_mm:
+            ops = deltaOps(src_mm, dst_mm, block_size, int(src_size * max_literal_ratio))
+            if ops is None:
+                return None
+            written = 0
+            reused = 0
+            try:
+                with open(tmp_path, 'wb') as ftmp:
+                    tmp_st = os.fstat(ftmp.fileno())
+                    if (tmp_st.st_uid, tmp_st.st_gid) != (dst_st.st_uid, dst_st.st_gid):
+                        # PermissionError when not allowed to, the caller then copies into dst instead
+                        os.fchown(ftmp.fileno(), dst_st.st_uid, dst_st.st_gid)
+                    for kind, offset, length in ops:
+                        if kind == 'literal':
+                            ftmp.write(src_mm[offset:offset + length])
+                            written += length
+                            continue
+                        ftmp.flush()
+                        remaining = length
+                        if hasattr(os, 'copy_file_range'):
+                            try:
+                                while remaining > 0:
+                                    sent = os.copy_file_range(fdst.fileno(), ftmp.fileno(), remaining,
+                                                              offset + length - remaining)
+                                    if sent == 0:
+                                        break
+                                    remaining -= sent
+                            except OSError:
+                                pass
+                            # The fd moved under the buffered file object
+                            ftmp.seek(0, os.SEEK_END)
+                        if remaining > 0:
+                            ftmp.write(dst_mm[offset + length - remaining:offset + length])
+                        reused += length
+                os.replace(tmp_path, dst)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+    return written, reused
+
+
+DATA_COPY_FUNCTIONS = {
+    'reflink': reflinkFile,
+    'copy_file_range': copyFileRange,
+    'sendfile': sendfileCopy,
+}
+
+
+class FileCopier:
+    '''
+    Wraps the shutil.copy calls used when deploying so the copy mode and the per run byte counts live in one place.
+    :param skip_unchanged: leave destinations that already hold the same bytes untouched
+    :param hash_cache_path: json file used to keep content hashes between runs (None keeps them in memory only)
+    :param strategies: placement strategies to try in order, see PLACEMENT_STRATEGIES
+    :param replace_links: write changed files to a new inode instead of into dst, so other hardlinks to dst
+        (the live release a staged release was linked from) keep their bytes
+    :param delta_min_size: smallest destination the 'delta' strategy is tried for
+    :param hash_cache: HashCache to use instead of loading one from hash_cache_path, i.e. one kept by a long running process
+    '''
+    def __init__(self, skip_unchanged=True, hash_cache_path=None, strategies=PLACEMENT_STRATEGIES, replace_links=False,
+                 delta_min_size=DELTA_MIN_SIZE, hash_cache=None):
+        self.skip_unchanged = skip_unchanged
+        self.replace_links = replace_links
+        self.delta_min_size = delta_min_size
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache(hash_cache_path)
+        self.strategies = list(strategies)
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.strategy_counts = {}
+        self.delta_files = 0
+        self.delta_written_bytes = 0
+        self.delta_file_bytes = 0
+        # (src, st_dev of the destination dir) -> first destination placed there, for the hardlink strategy
+        self.staged = {}
+        # copy() is called from the PlacementExecutor worker threads
+        self.lock = threading.Lock()
+
+    def count(self, dst, strategy, nbytes):
+        with self.lock:
+            if strategy == 'unchanged':
+                self.skipped_files += 1
+                self.skipped_bytes += nbytes
+            else:
+                self.copied_files += 1
+                self.copied_bytes += nbytes
+            self.strategy_counts[strategy] = self.strategy_counts.get(strategy, 0) + 1
+        logger.debug('placed: {} ({})'.format(dst, strategy))
+
+    def place(self, src, dst):
+        '''
+        Writes src's bytes to dst with the first strategy that works, falling back to shutil.copyfile.
+        :return: name of the strategy used
+        '''
+        dst_dev = None
+        if 'hardlink' in self.strategies:
+            dst_dev = os.stat(os.path.dirname(dst) or '.').st_dev
+            with self.lock:
+                staged = self.staged.get((src, dst_dev))
+            if staged is not None and staged != dst:
+                try:
+                    hardlinkFile(staged, dst)
+                    return 'hardlink'
+                except OSError:
+                    pass
+
+        if 'delta' in self.strategies:
+            # Always goes through a temp file and a rename, so it is safe with replace_links too
+            try:
+                dst_st = os.stat(dst)
+            except OSError:
+                dst_st = None
+            # The rename would unlink dst from its other links, which only replace_links wants
+            if dst_st is not None and dst_st.st_size >= self.delta_min_size and \
+                    (dst_st.st_nlink == 1 or self.replace_links):
+                delta = None
+                try:
+                    delta = deltaFile(src, dst)
+                except (OSError, ValueError):
+                    pass
+                if delta is not None:
+                    with self.lock:
+                        self.delta_files += 1
+                        self.delta_written_bytes += delta[0]
+                        self.delta_file_bytes += delta[0] + delta[1]
+                    logger.debug('delta: {} wrote {} of {} bytes'.format(dst, delta[0], delta[0] + delta[1]))
+                    self.copyMetadata(src, dst)
+                    return 'delta'
+
+        if self.replace_links:
+            try:
+                os.remove(dst)
+            except FileNotFoundError:
+                pass
+
+        used = None
+        for strategy in self.strategies:
+            copy_function = DATA_COPY_FUNCTIONS.get(strategy)
+            if copy_function is None:
+                continue
+            try:
+                copy_function(src, dst)
+                used = strategy
+                break
+            except OSError:
+                # Not supported here (EXDEV, EOPNOTSUPP, EINVAL, ...), try the next one
+                continue
+        if used is None:
+            shutil.copyfile(src, dst)
+            used = 'copy'
+
+        self.copyMetadata(src, dst)
+
+        if dst_dev is not None:
+            with self.lock:
+                self.staged.setdefault((src, dst_dev), dst)
+        return used
+
+    def copyMetadata(self, src, dst):
+        # Same metadata as shutil.copy (mode) or shutil.copy2 (mode + mtime, needed by the unchanged check)
+        if self.skip_unchanged:
+            shutil.copystat(src, dst)
+        else:
+            shutil.copymode(src, dst)
+
+    def isUnchanged(self, src, dst, src_st):
+        try:
+            dst_st = os.stat(dst)
+        except OSError:
+            return False
+        if dst_st.st_size != src_st.st_size:
+            return False
+        if dst_st.st_mtime_ns == src_st.st_mtime_ns:
+            return True
+        if self.hash_cache.digest(src, src_st) != self.hash_cache.digest(dst, dst_st, linked=self.replace_links):
+            return False
+        # Same bytes, so line the mtimes up and the next run can skip this pair without hashing
+        os.utime(dst, ns=(dst_st.st_atime_ns, src_st.st_mtime_ns))
+        return True
+
+    def copy(self, src, dst):
+        '''
+        Same as shutil.copy(src, dst, follow_symlinks=False) unless the destination already matches.
+        :return: True if dst was written, False if it was skipped
+        '''
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if os.path.islink(src):
+            shutil.copy(src, dst, follow_symlinks=False)
+            self.count(dst, 'symlink', os.lstat(src).st_size)
+            return True
+
+        src_st = os.stat(src)
+        if self.skip_unchanged and self.isUnchanged(src, dst, src_st):
+            self.count(dst, 'unchanged', src_st.st_size)
+            if 'hardlink' in self.strategies:
+                # An up to date destination is as good a staged copy as a freshly placed one
+                dst_dev = os.stat(os.path.dirname(dst) or '.').st_dev
+                with self.lock:
+                    self.staged.setdefault((src, dst_dev), dst)
+            return False
+
+        strategy = self.place(src, dst)
+        self.count(dst, strategy, src_st.st_size)
+        return True
+
+    def save(self):
+        self.hash_cache.save()
+
+    def report(self):
+        by_strategy = ', '.join('{}: {}'.format(k, v) for k, v in sorted(self.strategy_counts.items()))
+        report = 'Copied {} files ({} bytes), skipped {} unchanged files ({} bytes) [{}]'.format(
+            self.copied_files, self.copied_bytes, self.skipped_files, self.skipped_bytes, by_strategy)
+        if self.delta_files:
+            report += ', delta wrote {} of {} bytes in {} files'.format(
+                self.delta_written_bytes, self.delta_file_bytes, self.delta_files)
+        return report
+
+
+class PlacementExecutor:
+    '''
+    Runs file placement on a bounded thread pool.
+    An operation waits for the previously submitted operations that touch any of the same paths, so a rename,
+    delete and write of one path keep their order while unrelated files are copied concurrently.
+    :param max_workers: number of copy threads
+    :param copier: FileCopier used for copies (plain shutil.copy when None)
+    :param max_pending: submit() blocks once this many operations are queued or running
+    :param metrics: deployMetrics.Metrics, the time, files and bytes of every op submitted with a label are recorded
+        under that label
+    '''
+    def __init__(self, max_workers=COPY_WORKERS, copier=None, max_pending=None, metrics=None):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.copier = copier
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # Only paths with an operation still in flight are kept here
+        self.last_op_for_path = {}
+        self.pending = set()
+        self.slots = threading.Semaphore(max_pending or max_workers * MAX_PENDING_PER_WORKER)
+        self.failures = []
+        # Every failure of the run, wait() only hands out the ones since the last call
+        self.failure_count = 0
+        self.made_dirs = set()
+        # Every path an op was submitted for, what an in place deploy changed (see ReleaseStore.recordChanges)
+        self.touched = set()
+
+    def makeParentDir(self, path):
+        # Each parent dir is created once per run no matter how many files land in it
+        parent = os.path.dirname(path)
+        if not parent:
+            return
+        with self.lock:
+            if parent in self.made_dirs:
+                return
+        os.makedirs(parent, exist_ok=True)
+        with self.lock:
+            self.made_dirs.add(parent)
+
+    def submit(self, action, paths, fn, *args, label=None):
+        self.slots.acquire()
+        op = Future()
+        keys = [os.path.abspath(p) for p in paths]
+        deps = set()
+        with self.lock:
+            self.touched.update(keys)
+            for key in keys:
+                prev = self.last_op_for_path.get(key)
+                if prev is not None:
+                    deps.add(prev)
+                self.last_op_for_path[key] = op
+            self.pending.add(op)
+
+        def opDone(_):
+            with self.lock:
+                for key in keys:
+                    if self.last_op_for_path.get(key) is op:
+                        del self.last_op_for_path[key]
+                self.pending.discard(op)
+            self.slots.release()
+        op.add_done_callback(opDone)
+
+        if not deps:
+            self.pool.submit(self.run, op, action, paths, fn, args, label)
+            return op
+
+        # Queued on the pool once every earlier op on the same paths has finished (successfully or not)
+        remaining = [len(deps)]
+        def depDone(_):
+            with self.lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self.pool.submit(self.run, op, action, paths, fn, args, label)
+        for dep in deps:
+            dep.add_done_callback(depDone)
+        return op
+
+    def run(self, op, action, paths, fn, args, label=None):
+        started = time.monotonic()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            with self.lock:
+                self.failures.append((action, paths[-1], e))
+                self.failure_count += 1
+            # Ops waiting on this one still run, only callers checking op.exception() see it failed
+            op.set_exception(e)
+            return
+        if label is not None and self.metrics is not None:
+            nbytes = 0
+            if action == 'copy':
+                try:
+                    nbytes = os.path.getsize(paths[-1])
+                except OSError:
+                    pass
+            self.metrics.record(label, time.monotonic() - started, files=1, nbytes=nbytes)
+        op.set_result(result)
+
+    def doCopy(self, src, dst):
+        self.makeParentDir(dst)
+        if self.copier is not None:
+            return self.copier.copy(src, dst)
+        return shutil.copy(src, dst, follow_symlinks=False)
+
+    def doMove(self, src, dst):
+        if os.path.exists(src):
+            self.makeParentDir(dst)
+            os.replace(src, dst)
+            logger.debug('moved: {} to: {}'.format(src, dst))
+        else:
+            logger.info("The src path does not exist: {}".format(src))
+
+    def doDelete(self, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+            logger.debug('removed: {}'.format(dst))
+        else:
+            logger.info("The path does not exist: {}".format(dst))
+
+    def copy(self, src, dst, label=None):
+        return self.submit('copy', [src, dst], self.doCopy, src, dst, label=label)
+
+    def move(self, src, dst, label=None):
+        return self.submit('move', [src, dst], self.doMove, src, dst, label=label)
+
+    def delete(self, dst, label=None):
+        return self.submit('delete', [dst], self.doDelete, dst, label=label)
+
+    def wait(self):
+        '''
+        Blocks until everything submitted so far has run.
+        :return: list of (action, path, exception) for the operations that failed since the last wait()
+        '''
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            wait(pending)
+        with self.lock:
+            failures = self.failures
+            self.failures = []
+        return failures
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
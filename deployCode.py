@@ -1,43 +1,119 @@
 import os
 import sys
+import argparse
+import logging
 import git
 import re
+import signal
 import shutil
+import threading
+import hashlib
 from git import Repo, RemoteProgress
 from pprint import pprint
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from jarIndex import scanJarLocations, loadJarLocations
+from copyEngine import FileCopier, PlacementExecutor, HashCache
+from buildCache import BuildCache
+from antRunner import antCommand, runAntInvocation
+from pathClassifier import PathClassifier, SITE_FILE, JAR_SOURCE, JAR_SRC_PARENT_DIRNAMES
+from deployFilter import DeployFilter
+from stagedRelease import StagedRelease
+from releaseStore import ReleaseStore
+from deployPlan import makePlan, writePlan, readPlan, iterPlanPairs, planSummary
+from deployWatcher import Watcher, startHealthServer
+from taskGraph import TaskGraph, FAILED
+from deployMetrics import Metrics, writeMetricsJson, writeMetricsTextfile, profiled
 
 
 
 # Reference GitPython module doc here: https://buildmedia.readthedocs.org/media/pdf/gitpython/1.0.2/gitpython.pdf
 DRY_RUN = True
 VERBOSE = True
+LOG_LEVEL = 'INFO' # DEBUG logs every changed file as it goes through the pipeline
+DIFF_READ_SIZE = 64 * 1024
 ROOT_DIR = './'
 # TODO: add slash to beginning of GIT_REPO_DIR before deploying on app VM
 # TODO: replace: /aotx_azure with /{}.format(BRANCH_NAME)) on app VM
 GIT_REPO_DIR = 'datadisk/aotx_azure'
 LOCAL_GIT_JAR_DIR_PATH = GIT_REPO_DIR + '/site_specific/jars' #also contains .war
+JAR_FILE_EXTENSIONS = ('.jar', '.war') # files in LOCAL_GIT_JAR_DIR_PATH the jar commit stages, the dir holds other files too
 COMPILED_JARS_DIR = GIT_REPO_DIR + '/jars'
+JAR_MANIFEST_PATH = 'jar_locations_manifest.json' # saved locations of every jar/war under the root dir, see jarIndex.py
+SKIP_UNCHANGED = True # don't rewrite destinations that already hold the same bytes, see copyEngine.py
+HASH_CACHE_PATH = 'file_hash_cache.json'
+PLACEMENT_STRATEGIES = ['reflink', 'copy_file_range', 'sendfile'] # add 'hardlink' to link every fanned out jar to one copy per filesystem, put 'delta' first for big files that change a little
+DELTA_MIN_SIZE = 8 * 1024 * 1024 # existing destinations at least this big only get their changed blocks written ('delta' strategy)
+COPY_WORKERS = 8 # threads used to place files on the app VM, see copyEngine.PlacementExecutor
 EWO_JAR_SRC_FILES = GIT_REPO_DIR + '/ewo'
 CIC_JAR_SRC_FILES = GIT_REPO_DIR + '/cic'
 AOTX_SECURE_JAR_SRC_FILES = GIT_REPO_DIR + '/aotx-secure'
 AOTL_PROJECT_JAR_SRC_FILES = GIT_REPO_DIR + '/aotl-project'
 JAR_SRC_DIRNAMES = ['ewo', 'cic', 'aotl-project', 'aotx-secure','aotlservlet', 'aotxreports']
+# ant target -> targets it depends on. A change to a target's source also rebuilds every target that depends on it.
+# i.e. {'aotlservlet': ['aotl-project']}
+ANT_TARGET_DEPENDENCIES = {}
+# ant target -> .jar/.war filenames it writes into LOCAL_GIT_JAR_DIR_PATH. Targets left out are detected by what changed in the dir during their build.
+ANT_TARGET_ARTIFACTS = {}
+JAR_SRC_PARENT_DIR = 'site_agnostic'
 XML_DIR_PATH = GIT_REPO_DIR + '/site_agnostic/build.xml'
+BUILD_CACHE_DIR = 'build_cache' # built jars/wars keyed by source tree hash, see buildCache.py
+BUILD_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+ANT_MAX_PARALLEL = 2 # ant processes run at once for targets that don't depend on each other
+DEPLOY_GRAPH_WORKERS = 8 # steps of a deploy run at once (site file copy, ant builds, jar fan-out), see taskGraph.py
 
 REMOTE_NAME = 'origin'
 BRANCH_NAME = 'main' #Examples: SE, WEST, MOKA
 REMOTE_BRANCH = 'remotes{}{}'.format(REMOTE_NAME, BRANCH_NAME)
-
-
-
-def git_fetch(output_dst, rmt_name,branch_name, gitdir=GIT_REPO_DIR):
-	# TODO: Fetch from SE only
-	os.system('cd {} && git fetch {} {} && git status > {}/latest_git_status.txt'.format(gitdir, rmt_name, branch_name, output_dst))
-
-def git_diff(repo, rmt_name, branch_name, output_dst, gitdir=GIT_REPO_DIR):
-	os.system('cd {} && git fetch {} {} && git diff --name-only {}/{} > {}/latest_git_diff.txt'.format(gitdir, rmt_name, branch_name, rmt_name, branch_name, output_dst))
+SITE_BRANCHES = ['SE', 'WEST', 'MOKA'] # site branches deployed together with --sites
+SITE_DST_ROOTS = {} # site branch -> root dir its files are deployed under, every site deployed with --sites needs one of its own
+SITE_WORKTREES_DIR = GIT_REPO_DIR + '_sites' # one git worktree per site branch for --sites
+STAGED_DEPLOY = False # build each release next to the live one and swap it in at once, see stagedRelease.py. ROOT_DIR/SITE_DST_ROOTS must then name the live app dir (a symlink after the first run)
+RELEASES_DIR = 'releases' # release dirs for STAGED_DEPLOY, one subdir per branch/site, on the same filesystem as the live app dir
+RELEASE_STORE_DIR = 'release_store' # every deployed release by content hash, for rollback, see releaseStore.py
+RELEASE_RETENTION = 10 # releases kept per branch/site besides the live one
+DEPLOY_PLAN_PATH = 'deploy_plan.json' # written by `plan`, run by `apply`, see deployPlan.py
+WATCH_INTERVAL = 60 # seconds between fetches for `watch`, see deployWatcher.py
+WATCH_DEBOUNCE = 30 # seconds the remote has to stay on a commit before `watch` deploys it
+WATCH_MAX_BACKOFF = 15 * 60 # longest wait after failed fetches/deploys
+WATCH_STATUS_ADDRESS = ('127.0.0.1', 8787) # GET /health and /status while `watch` runs
+DEPLOY_IGNORE_RULES = ['~$*', '*.pdf', '*.docx', '*.pptx'] # never deployed from site_specific/<branch>, more rules go in .deployignore files, see deployFilter.py
+METRICS_JSON_PATH = 'deploy_metrics.json' # time, files and bytes per phase of the last run, see deployMetrics.py
+METRICS_TEXTFILE_PATH = None # same as a Prometheus textfile, i.e. '/var/lib/node_exporter/textfile_collector/deploy.prom'
+
+
+
+logger = logging.getLogger('deployCode')
+# Phases of the current run, reset by each deploy of a watch process and in each --sites worker
+metrics = Metrics()
+
+
+class Change:
+	'''One entry of the diff between the deployed commit and the remote branch'''
+	__slots__ = ('change_type', 'a_path', 'b_path', 'blob', 'score')
+
+	def __init__(self, change_type, a_path, b_path, blob=None, score=None):
+		self.change_type = change_type
+		self.a_path = a_path
+		self.b_path = b_path
+		self.blob = blob # hex SHA of the file's content, before the change for D and after it otherwise
+		self.score = score # similarity of a rename/copy in percent, 100 when the content didn't change
+
+
+def write_git_output(output_dst, filename, text):
+	with open(os.path.join(output_dst, filename), 'w') as f:
+		f.write(text + '\n')
+
+def git_fetch(repo, output_dst, rmt_name, branch_name):
+	# The only call in a deploy that talks to the remote. git_diff and run_git_pull work off the fetched ref.
+	with metrics.phase('fetch'):
+		repo.remote(rmt_name).fetch(branch_name)
+	write_git_output(output_dst, 'latest_git_status.txt', repo.git.status())
+
+def git_diff(repo, rmt_name, branch_name, output_dst):
+	rmt_branch = '{}/{}'.format(rmt_name, branch_name)
+	write_git_output(output_dst, 'latest_git_diff.txt', repo.git.diff('--name-only', rmt_branch))
 	diff_paths = {
 		'A': [],
 		'D': [],
@@ -57,40 +133,78 @@ def git_diff(repo, rmt_name, branch_name, output_dst, gitdir=GIT_REPO_DIR):
 		'U': []  #??
 	}
 
-	rmt_branch = '{}/{}'.format(rmt_name, branch_name)
 	changes = repo.index.diff(rmt_branch)
 
 	for file_diff in changes:
-		print('Type of Change: {}, a_path: {}, b_path: {}'.format(file_diff.change_type, file_diff.a_path, file_diff.b_path))
-		# TODO: Filter out filetypes that we don't need to update here
+		logger.debug('Type of Change: {}, a_path: {}, b_path: {}'.format(file_diff.change_type, file_diff.a_path, file_diff.b_path))
 		diff_paths[file_diff.change_type].append((file_diff.a_path, file_diff.b_path))
 		diff_objects_by_type[file_diff.change_type].append(file_diff)
 
 	return diff_paths, diff_objects_by_type
 
 
+def iter_nul_fields(stream):
+	rest = b''
+	for chunk in iter(lambda: stream.read(DIFF_READ_SIZE), b''):
+		fields = (rest + chunk).split(b'\0')
+		rest = fields.pop()
+		for field in fields:
+			yield field.decode('utf-8', 'surrogateescape')
+	if rest:
+		yield rest.decode('utf-8', 'surrogateescape')
+
+def iter_git_changes(repo, base, target, output_dst=None, paths=None):
+	'''
+	Streams `git diff --raw -M -z base target` one Change at a time instead of building a DiffIndex.
+	The raw format carries the blob SHAs too, so later stages can look up sizes without touching the work tree.
+	:param output_dst: dir to write latest_git_diff.txt (changed paths, one per line) into while the diff is read
+	:param paths: only diff these repo relative paths (pathspecs), everything when None
+	'''
+	pathspecs = ['--'] + list(paths) if paths else []
+	proc = repo.git.diff(base, target, '--raw', '-M', '-z', '--no-abbrev', '--no-color', *pathspecs, as_process=True)
+	out = open(os.path.join(output_dst, 'latest_git_diff.txt'), 'w') if output_dst else None
+	finished = False
+	try:
+		fields = iter_nul_fields(proc.stdout)
+		for header in fields:
+			# ':<old mode> <new mode> <old sha> <new sha> <status>'
+			meta = header.split(' ')
+			letter = meta[4][0]
+			a_path = next(fields)
+			b_path = next(fields) if letter in ('R', 'C') else a_path
+			if out is not None:
+				out.write(b_path + '\n')
+			score = int(meta[4][1:]) if letter in ('R', 'C') and meta[4][1:] else None
+			yield Change(letter, a_path, b_path, blob=meta[2] if letter == 'D' else meta[3], score=score)
+		finished = True
+	finally:
+		if out is not None:
+			out.close()
+		if finished:
+			proc.wait()
+		else:
+			# Stopped early, don't leave git blocked on a full pipe
+			proc.proc.kill()
+			proc.proc.wait()
+
 def remove_codecloud_path_prefixes(apath, branch_name):
 	sub_path = 'site_specific/{}'.format(branch_name) + '/'
 	try:
 		dsts = apath.split(sub_path)
-		print(dsts)
+		logger.debug(dsts)
 		dst = dsts[1]
 		return dst
 
 	except:
 		return apath
 
-def check_if_src_path_is_related_to_jar_source_code(apath):
-	top_dir_for_non_jar_src_code = 'site_specific/{}'.format(BRANCH_NAME) + '/'
-	return apath.find(top_dir_for_non_jar_src_code)
-
-def prepare_changes_for_A_or_M(letter, diff_data, dst_root=ROOT_DIR, dry_run=False):
+def prepare_changes_for_A_or_M(letter, diff_data, dst_root=ROOT_DIR, dry_run=False, gitdir=GIT_REPO_DIR, branch_name=BRANCH_NAME):
 	'''letter can be 'A' or 'M' but none of the other git diff types'''
 	# Gather list of directories within the git repo dir. Used in dynamic path processing to get the relative path.
 	print("working on: {}".format(letter))
 
 	src_subdirs = {}
-	for subdir in os.scandir(GIT_REPO_DIR):
+	for subdir in os.scandir(gitdir):
 		if subdir.is_dir():
 			dir_name = os.path.basename(subdir)
 			src_subdirs[dir_name] = len(dir_name)
@@ -99,13 +213,13 @@ def prepare_changes_for_A_or_M(letter, diff_data, dst_root=ROOT_DIR, dry_run=Fal
 	diff = diff_data[letter]
 	dst_path = dst_root
 	src_to_dst_pairs = []
-	src_path = GIT_REPO_DIR + '/'
+	src_path = gitdir + '/'
 
 	for a_diff in diff:
 		src_path += a_diff.a_path
 		# Dynamic path processing to get the path used relative to the root directory
-		dst_path = dst_root + a_diff.a_path
-		dst_path = remove_codecloud_path_prefixes(dst_path, BRANCH_NAME)
+		# The site prefix comes off the repo path before dst_root goes on, so a per site dst_root is kept
+		dst_path = dst_root + remove_codecloud_path_prefixes(a_diff.a_path, branch_name)
 		src_to_dst_pairs.append((src_path, dst_path))
 	#
 	# # 	located_in_subdir = False
@@ -141,12 +255,12 @@ def prepare_changes_for_A_or_M(letter, diff_data, dst_root=ROOT_DIR, dry_run=Fal
 	# # 		src_to_dst_pairs.append((src_path, dst_path))
 	# #
 	# # 	# Reset src and dst paths
-		src_path = GIT_REPO_DIR + '/'
+		src_path = gitdir + '/'
 		dst_path = dst_root
 
 	return src_to_dst_pairs
 
-def prepare_changes_for_R(diff_data):
+def prepare_changes_for_R(diff_data, dst_root='', branch_name=BRANCH_NAME):
 	print("working on R:")
 
 	diff = diff_data['R']
@@ -155,11 +269,11 @@ def prepare_changes_for_R(diff_data):
 		src = a_diff.a_path
 		# Dynamic path processing to get the path used relative to the root directory
 		dst = a_diff.b_path
-		dst = remove_codecloud_path_prefixes(dst, BRANCH_NAME)
+		dst = dst_root + remove_codecloud_path_prefixes(dst, branch_name)
 		src_dst_pairs_list.append((src, dst))
 	return src_dst_pairs_list
 
-def prepare_changes_for_D(diff_data):
+def prepare_changes_for_D(diff_data, dst_root='', branch_name=BRANCH_NAME):
 	print("working on R:")
 	diff = diff_data['D']
 	src_dst_pairs_list = []
@@ -167,12 +281,12 @@ def prepare_changes_for_D(diff_data):
 		src = a_diff.a_path
 		# Dynamic path processing to get the path used relative to the root directory
 		dst = a_diff.b_path
-		dst = remove_codecloud_path_prefixes(dst, BRANCH_NAME)
+		dst = dst_root + remove_codecloud_path_prefixes(dst, branch_name)
 		src_dst_pairs_list.append((src,dst))
 	return src_dst_pairs_list
 
 
-def prepare_to_deploy_changes(diff_data, dst_root=ROOT_DIR, dry_run=False):
+def prepare_to_deploy_changes(diff_data, dst_root=ROOT_DIR, dry_run=False, gitdir=GIT_REPO_DIR, branch_name=BRANCH_NAME):
 	# Setup for all these operations:
 
 	# Gather list of directories within the git repo dir. Used in dynamic path processing to get the relative path.
@@ -190,7 +304,9 @@ def prepare_to_deploy_changes(diff_data, dst_root=ROOT_DIR, dry_run=False):
 		letter='A',
 		diff_data=diff_data,
 		dst_root=dst_root,
-		dry_run=dry_run
+		dry_run=dry_run,
+		gitdir=gitdir,
+		branch_name=branch_name
 	)
 
 
@@ -199,32 +315,159 @@ def prepare_to_deploy_changes(diff_data, dst_root=ROOT_DIR, dry_run=False):
 		letter='M',
 		diff_data=diff_data,
 		dst_root=dst_root,
-		dry_run=dry_run
+		dry_run=dry_run,
+		gitdir=gitdir,
+		branch_name=branch_name
 	)
 
 	# HANDLING 'R': FILEPATHS THAT HAVE BEEN MOVED / RENAMED
-	src_to_dst_pairs_all['R'] = prepare_changes_for_R(diff_data)
+	src_to_dst_pairs_all['R'] = prepare_changes_for_R(diff_data, dst_root=dst_root, branch_name=branch_name)
 
 
 	# HANDLING 'D': FILEPATHS THAT NO LONGER EXIST
-	src_to_dst_pairs_all['D'] = prepare_changes_for_D(diff_data)
+	src_to_dst_pairs_all['D'] = prepare_changes_for_D(diff_data, dst_root=dst_root, branch_name=branch_name)
 
 	print('Finished preparing changes')
 	return src_to_dst_pairs_all
 
 
-def deploy_changes_for_A_or_M(src_dst_dict, letter, dry_run=False):
+def iter_deploy_pairs(changes, dst_root=ROOT_DIR, gitdir=GIT_REPO_DIR, branch_name=BRANCH_NAME, jar_targets=None, classifier=None):
+	'''
+	Classifies and rewrites each Change as it arrives, one trie lookup per path (see pathClassifier.py).
+	A/M copy from the repo, D removes the destination. An exact rename (R100) moves the deployed file from its old
+	destination to its new one, a rename that also changed the file is deployed as D of the old one and A of the new one.
+	:param jar_targets: set that collects the ant targets with source changes
+	:param classifier: PathClassifier built for branch_name/dst_root (built once here when None)
+	:return: generator of (change type, src, dst) for the site specific files to deploy
+	'''
+	if classifier is None:
+		classifier = PathClassifier(branch_name, JAR_SRC_DIRNAMES, dst_root=dst_root)
+	for change in changes:
+		letter = change.change_type
+		if letter not in ('A', 'M', 'R', 'D'):
+			continue
+		category, value = classifier.classify(change.b_path)
+		old_category, old_value = classifier.classify(change.a_path) if letter == 'R' else (category, value)
+
+		if jar_targets is not None:
+			if category == JAR_SOURCE:
+				jar_targets.add(value)
+			if old_category == JAR_SOURCE:
+				jar_targets.add(old_value)
+
+		if letter in ('A', 'M'):
+			if category == SITE_FILE:
+				yield letter, gitdir + '/' + change.a_path, value
+		elif letter == 'D':
+			if category == SITE_FILE:
+				yield letter, change.a_path, value
+		elif category == SITE_FILE and old_category == SITE_FILE and change.score == 100:
+			yield letter, old_value, value
+		elif category == SITE_FILE and old_category == SITE_FILE:
+			# Renamed and edited (-M pairs files that are only similar), the deployed bytes are stale: copy the new
+			# content from the repo and drop the old destination
+			yield 'D', change.a_path, old_value
+			yield 'A', gitdir + '/' + change.b_path, value
+		elif category == SITE_FILE:
+			# Moved in from outside the site dir, nothing deployed to move yet
+			yield 'A', gitdir + '/' + change.b_path, value
+		elif old_category == SITE_FILE:
+			# Moved out of the site dir
+			yield 'D', change.a_path, old_value
+
+def deploy_change_stream(pairs, executor=None, dry_run=False):
+	'''
+	Hands each (change type, src, dst) to the executor as it arrives. The executor keeps ops on the same path in order.
+	:return: dictionary with the number of changes per type
+	'''
+	counts = {'A': 0, 'M': 0, 'R': 0, 'D': 0}
+	for letter, src, dst in pairs:
+		counts[letter] += 1
+		logger.debug('{} src: {} | dst: {}'.format(letter, src, dst))
+		if dry_run:
+			continue
+		# The executor records each op's time, files and bytes under deploy_<change type>
+		if letter in ('A', 'M'):
+			executor.copy(src, dst, label='deploy_' + letter)
+		elif letter == 'R':
+			executor.move(src, dst, label='deploy_' + letter)
+		else:
+			executor.delete(dst, label='deploy_' + letter)
+	return counts
+
+def get_deploy_filter(repo, target, branch_name=BRANCH_NAME):
+	'''
+	:param target: commit being deployed, the .deployignore files are read from its tree rather than the work tree
+	'''
+	tree = repo.commit(target).tree
+
+	def read_rules_file(path):
+		try:
+			return (tree / path).data_stream.read().decode('utf-8', 'replace')
+		except KeyError:
+			return None
+
+	return DeployFilter(read_rules_file, 'site_specific/{}'.format(branch_name), default_rules=DEPLOY_IGNORE_RULES)
+
+def iter_filtered_changes(changes, deploy_filter, repo):
+	'''
+	Drops the changes deploy_filter excludes before anything downstream looks at them. Sizes of the dropped files
+	come from the git object database, the files themselves are never touched.
+	A rename with only one excluded side becomes an add (moved in) or a delete (moved out) of the other side.
+	'''
+	for change in changes:
+		b_excluded = deploy_filter.isExcluded(change.b_path)
+		a_excluded = deploy_filter.isExcluded(change.a_path) if change.change_type == 'R' else b_excluded
+		if not a_excluded and not b_excluded:
+			yield change
+			continue
+		deploy_filter.count(repo.odb.info(bytes.fromhex(change.blob)).size)
+		if a_excluded and not b_excluded:
+			yield Change('A', change.b_path, change.b_path, blob=change.blob)
+		elif b_excluded and not a_excluded:
+			yield Change('D', change.a_path, change.a_path, blob=change.blob)
+
+def deploy_branch_changes(repo, base, rmt_branch, output_dst, executor=None, dst_root=ROOT_DIR, gitdir=GIT_REPO_DIR, branch_name=BRANCH_NAME, dry_run=False):
+	'''
+	Diff -> filter -> classification -> path rewrite -> placement, one change at a time so memory stays flat however many files changed.
+	:param base: commit the app VM was deployed from
+	:return: (dictionary of deployed change counts per type, set of ant targets with source changes, the DeployFilter with its counts)
+	'''
+	jar_targets = set()
+	classifier = get_path_classifier(branch_name, dst_root)
+	deploy_filter = get_deploy_filter(repo, rmt_branch, branch_name)
+	# Every stage is timed on its own (see deployMetrics.py), the filter counts what it dropped
+	changes = metrics.iterPhase('diff', iter_git_changes(repo, base, rmt_branch, output_dst=output_dst))
+	changes = metrics.iterPhase('filter', iter_filtered_changes(changes, deploy_filter, repo), count_items=False)
+	pairs = metrics.iterPhase('prepare', iter_deploy_pairs(changes, dst_root=dst_root, gitdir=gitdir, branch_name=branch_name,
+		jar_targets=jar_targets, classifier=classifier))
+	with metrics.phase('deploy_queue'):
+		counts = deploy_change_stream(pairs, executor=executor, dry_run=dry_run)
+	metrics.record('filter', files=deploy_filter.filtered_files, nbytes=deploy_filter.filtered_bytes)
+	return counts, jar_targets, deploy_filter
+
+def deploy_changes_for_A_or_M(src_dst_dict, letter, dry_run=False, copier=None, executor=None):
 	if dry_run:
 		pprint(src_dst_dict)
+	elif executor is not None:
+		# Parent dirs are created by the executor, once each
+		for src, dst in src_dst_dict[letter]:
+			executor.copy(src, dst)
 	else:
 		for src, dst in src_dst_dict[letter]:
 			os.makedirs(os.path.dirname(dst), exist_ok=True)
-			new_path = shutil.copy(src, dst, follow_symlinks=False)
+			if copier is not None:
+				copier.copy(src, dst)
+			else:
+				new_path = shutil.copy(src, dst, follow_symlinks=False)
 
-def deploy_changes_for_D(src_dst_dict, dry_run=False):
+def deploy_changes_for_D(src_dst_dict, dry_run=False, executor=None):
 	if dry_run:
 		print('Deleting files below:')
 		pprint(src_dst_dict['D'])
+	elif executor is not None:
+		for src, dst in src_dst_dict['D']:
+			executor.delete(dst)
 	else:
 		for src, dst in src_dst_dict['D']:
 			if os.path.exists(dst):
@@ -234,10 +477,13 @@ def deploy_changes_for_D(src_dst_dict, dry_run=False):
 			else:
 				print("The path does not exist: {}".format(dst))
 
-def deploy_changes_for_R(src_dst_dict, dry_run=False):
+def deploy_changes_for_R(src_dst_dict, dry_run=False, executor=None):
 	if dry_run:
 		print('Moving files below:')
 		pprint(src_dst_dict)
+	elif executor is not None:
+		for src, dst in src_dst_dict['R']:
+			executor.move(src, dst)
 	else:
 		for src, dst in src_dst_dict['R']:
 			if os.path.exists(src):
@@ -249,99 +495,191 @@ def deploy_changes_for_R(src_dst_dict, dry_run=False):
 				print("The src path does not exist: {}".format(src))
 
 
-def run_git_pull(output_dst=ROOT_DIR):
-	p = Path(os.getcwd()).parents[0]
-	if ROOT_DIR[-1] == '/':
-		os.system('cd {} && git pull > {}latest_git_pull.txt'.format(GIT_REPO_DIR, p))
-
-	else:
-		os.system('cd {} && git pull > {}/latest_git_pull.txt'.format(GIT_REPO_DIR, p))
-
-def ant_build(jarname, dry_run=False):
-	cwd = os.getcwd()
-	cwd_parent = Path(cwd).parent #should be root dir
-	xml_path = str(cwd_parent) + '/' + XML_DIR_PATH
-	cmd = "ant {} -f {}".format(jarname, xml_path)
-	if not dry_run:
-		os.system(cmd)
-	else:
-		print(cmd)
-
-
-def check_for_jar_src_code_changes(src_dst_dict):
-	change_types = src_dst_pairs_dict.values()
-	for changes in change_types:
-		for c in changes:
-			src, dst = c
-			dirs = src.split('/')
-			if "site_agnostic" in src:
-				print('found war change')
-				i = dirs.index('site_agnostic')
-				next_subdir = dirs[i+1]
-				if next_subdir in JAR_SRC_DIRNAMES:
-					print('^^^ {}: '.format(next_subdir))
-					return True
-
-			elif "site_specific" in src:
-				print('found jar change')
-				i = dirs.index('site_agnostic')
-				next_subdir = dirs[i+1]
-				if next_subdir in JAR_SRC_DIRNAMES:
-					print('^^^ {}: '.format(next_subdir))
-					return True
-			else:
-				pass
-
-
-			# print("dirs: {} ".format(dirs))
-			# first_dir = dirs[0]
-			# # first_dir = src.split('/')[0]
-			# if first_dir in JAR_SRC_DIRNAMES:
-			# 	return True
-
-	return False
+def run_git_pull(repo, rmt_name, branch_name, output_dst, target=None):
+	# Same merge git pull would do, but onto the ref git_fetch already brought down, no second trip to the remote
+	# target pins the merge to a commit (a plan's) instead of wherever the remote branch is now
+	rmt_branch = '{}/{}'.format(rmt_name, branch_name)
+	with metrics.phase('merge'):
+		output = repo.git.merge(target or rmt_branch)
+	write_git_output(output_dst, 'latest_git_pull.txt', output)
+
+def snapshot_jar_dir(jar_dir=LOCAL_GIT_JAR_DIR_PATH):
+	snapshot = {}
+	for entry in os.scandir(jar_dir):
+		if entry.is_file():
+			st = entry.stat()
+			snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+	return snapshot
+
+def ant_build_artifacts(jarname, before, jar_dir=LOCAL_GIT_JAR_DIR_PATH):
+	# Files the target wrote into the jar dir: the ones listed in ANT_TARGET_ARTIFACTS, otherwise whatever changed since `before`
+	if jarname in ANT_TARGET_ARTIFACTS:
+		return [os.path.join(jar_dir, fname) for fname in ANT_TARGET_ARTIFACTS[jarname]]
+	after = snapshot_jar_dir(jar_dir)
+	return [apath for apath, sig in after.items() if before.get(apath) != sig]
+
+def ant_xml_path():
+	cwd_parent = Path(os.getcwd()).parent #should be root dir
+	return str(cwd_parent) + '/' + XML_DIR_PATH
+
+def group_ant_targets(ordered_targets, dependencies=ANT_TARGET_DEPENDENCIES):
+	'''
+	:param ordered_targets: targets to build, dependencies first (see select_ant_targets)
+	:return: list of target lists. Targets linked through dependencies share a list (one ant process, in order),
+		separate lists don't depend on each other and can be built at the same time.
+	'''
+	group_of = {}
+	for target in ordered_targets:
+		group_of[target] = target
+	def find(target):
+		while group_of[target] != target:
+			target = group_of[target]
+		return target
+	for target in ordered_targets:
+		for dep in dependencies.get(target, []):
+			if dep in group_of:
+				group_of[find(target)] = find(dep)
+
+	groups = {}
+	for target in ordered_targets:
+		groups.setdefault(find(target), []).append(target)
+	return list(groups.values())
+
+def restore_cached_builds(targets, repo, build_cache, dry_run=False, dependencies=ANT_TARGET_DEPENDENCIES):
+	'''
+	:param targets: targets to build, dependencies first (see select_ant_targets)
+	:return: (dictionary mapping each target left to build to its cache key or None, targets left to build,
+		paths of the artifacts restored from the cache)
+	'''
+	keys = {}
+	to_build = []
+	restored = []
+	for target in targets:
+		key = None
+		if build_cache is not None and repo is not None:
+			key = build_cache.key(repo, target, src_parents=JAR_SRC_PARENT_DIRNAMES, build_xml_path=JAR_SRC_PARENT_DIR + '/build.xml')
+		# A target whose dependency gets rebuilt is rebuilt too, its cached jar may be built against the old one
+		dep_rebuilt = any(dep in to_build for dep in dependencies.get(target, []))
+		if key is not None and not dep_rebuilt and not dry_run:
+			paths = build_cache.restore(key, LOCAL_GIT_JAR_DIR_PATH)
+			if paths is not None:
+				logger.info('restored {} from build cache'.format(target))
+				restored.extend(paths)
+				continue
+		keys[target] = key
+		to_build.append(target)
+	return keys, to_build, restored
+
+def print_ant_results(targets, results):
+	for target in targets:
+		res = results[target]
+		logger.info('ant {}: exit code {}, {}'.format(target, res['exit_code'],
+			'{:.1f}s'.format(res['seconds']) if res['seconds'] is not None else 'not timed'))
+		metrics.record('ant:' + target, res['seconds'] or 0.0, files=1)
+
+def store_unmapped_build(built, keys, before, build_cache):
+	# Without ANT_TARGET_ARTIFACTS the changed files can only be attributed when a single target was built
+	unmapped = [t for t in built if t not in ANT_TARGET_ARTIFACTS]
+	if len(unmapped) != 1 or keys[unmapped[0]] is None:
+		return
+	mapped_paths = set()
+	for target in built:
+		if target in ANT_TARGET_ARTIFACTS:
+			mapped_paths.update(ant_build_artifacts(target, before))
+	artifacts = [apath for apath in ant_build_artifacts(unmapped[0], before) if apath not in mapped_paths]
+	build_cache.store(keys[unmapped[0]], artifacts)
+
+path_classifiers = {}
+
+def get_path_classifier(branch_name=BRANCH_NAME, dst_root=ROOT_DIR):
+	# One trie per branch for the whole run (or the whole life of a watch process), staged releases get a new dst_root each time
+	classifier = path_classifiers.get(branch_name)
+	if classifier is None:
+		classifier = path_classifiers[branch_name] = PathClassifier(branch_name, JAR_SRC_DIRNAMES, dst_root=dst_root)
+	if classifier.dst_root != dst_root:
+		classifier = classifier.withDstRoot(dst_root)
+	return classifier
+
+def changed_jar_targets(repo, base, target, branch_name=BRANCH_NAME):
+	'''
+	Ant targets with source changes between base and target, from a diff of the jar source dirs only. Quick to run
+	next to the full diff, so the builds don't wait for the site files to be read.
+	'''
+	classifier = get_path_classifier(branch_name)
+	paths = ['{}/{}'.format(parent, name) for parent in JAR_SRC_PARENT_DIRNAMES for name in JAR_SRC_DIRNAMES]
+	changed_targets = set()
+	for change in iter_git_changes(repo, base, target, paths=paths):
+		for apath in (change.a_path, change.b_path):
+			category, value = classifier.classify(apath)
+			if category == JAR_SOURCE:
+				changed_targets.add(value)
+	return changed_targets
+
+def select_ant_targets(changed_targets, dependencies=ANT_TARGET_DEPENDENCIES):
+	'''
+	:param changed_targets: ant targets with source changes, from changed_jar_targets or iter_deploy_pairs
+	:param dependencies: ant target -> targets it depends on
+	:return: list of the changed targets plus everything depending on them, dependencies first, otherwise in JAR_SRC_DIRNAMES order
+	'''
+	selected = set(changed_targets)
+	to_check = list(changed_targets)
+	while to_check:
+		target = to_check.pop()
+		for other, deps in dependencies.items():
+			if target in deps and other not in selected:
+				selected.add(other)
+				to_check.append(other)
+
+	ordered = []
+	visited = set()
+	def visit(target):
+		if target in visited:
+			return
+		visited.add(target)
+		for dep in dependencies.get(target, []):
+			if dep in selected:
+				visit(dep)
+		ordered.append(target)
+
+	for target in JAR_SRC_DIRNAMES:
+		if target in selected:
+			visit(target)
+	return ordered
 
 def findPathsToJar(filename, rootdir='.'):
-    # print(f'Grabbing all filepaths for {filename}')  # Press Ctrl+F8 to toggle the breakpoint.
-    # len_git_dir_path = len(GIT_REPO_DIR)
-    locations = []
-    for subdir, dirs, files in os.walk(rootdir):
-        for file in files:
-            bname = os.path.basename(file)
-            if bname == filename:
-                # TODO: remove the dirs used in CodeCloud but are not on server
-                fullpath = os.path.join(subdir, file)
-                locations.append(fullpath)
+    # TODO: remove the dirs used in CodeCloud but are not on server
+    return scanJarLocations([filename], rootdir=rootdir)[filename]
 
-    return locations
 
-
-def findPathsToAllJars(filenames, rootdir='.'):
+def findPathsToAllJars(filenames, rootdir='.', rescan=False, moved_root=False):
     '''
     :param filenames: a list of jar filename strings. i.e. ['aotxweb.jar', 'xyz.war, 'cic.jar']
     :param rootdir: a string of the directory path to recursively search through
+    :param rescan: ignore the saved jar manifest and walk the whole rootdir again
+    :param moved_root: rootdir is a new staged release, reuse the jar manifest of the release it was linked from
     :return: a dictionary mapping the basefilename to a list of all the filepaths discovered in the rootdir.
     '''
-
-    len_git_dir_path = len(GIT_REPO_DIR)
-    relevant_filepaths = {}
-    for fname in filenames:
-        list_of_paths_to_fname = findPathsToJar(fname, rootdir=rootdir)
-        relevant_paths_to_fname = []
-        # TODO: Verify if we should ignore gitrepo dir when making replacements
-        # Filtering out gitrepo dir b/c irrelevant to update these
-        for apath in list_of_paths_to_fname:
-            if apath[0:len_git_dir_path] != GIT_REPO_DIR:
-                relevant_paths_to_fname.append(apath)
-        relevant_filepaths[fname] = relevant_paths_to_fname
-
-    return relevant_filepaths
-
-def replaceOldJARs(source_filepaths, rootdir='.', verbose=False, dryrun=False):
+    # One walk of rootdir for every filename at once instead of one os.walk per jar. The result is saved in
+    # JAR_MANIFEST_PATH so later runs only re-scan the directories that changed since.
+    # TODO: Verify if we should ignore gitrepo dir when making replacements
+    # Skipping gitrepo dir during the walk b/c irrelevant to update these. Same for the other dirs this script keeps
+    # jars in: the build cache holds the builds of older sources, the site worktrees have their own jar dirs, and old
+    # releases/the release store must keep the jars they were recorded with.
+    skipdirs = [GIT_REPO_DIR, SITE_WORKTREES_DIR, BUILD_CACHE_DIR, RELEASES_DIR, RELEASE_STORE_DIR]
+    return loadJarLocations(filenames, rootdir=rootdir, skipdirs=skipdirs, manifest_path=JAR_MANIFEST_PATH, rescan=rescan,
+                            moved_root=moved_root)
+
+def replaceOldJARs(source_filepaths, rootdir='.', verbose=False, dryrun=False, rescan=False, copier=None, executor=None):
+    '''
+    Copies each jar/war over every file of the same name under rootdir.
+    :param executor: PlacementExecutor to run the copies on, waited for before returning
+    :return: (jar filenames, dictionary mapping each filename to its destinations, list of (action, path, exception)
+        for the copies that failed)
+    '''
     filenames = []
     for fpath in source_filepaths:
         filenames.append(os.path.basename(fpath))
-    destination_filepaths = findPathsToAllJars(filenames, rootdir=rootdir)
+    destination_filepaths = findPathsToAllJars(filenames, rootdir=rootdir, rescan=rescan)
     for fname, fpath in zip(filenames, source_filepaths):
         src = fpath
         dest_fpaths = destination_filepaths[fname]
@@ -349,12 +687,140 @@ def replaceOldJARs(source_filepaths, rootdir='.', verbose=False, dryrun=False):
             if verbose:
                 print('src: {} | dst: {}'.format(src, dst))
             if dryrun is False:
-                newPath = shutil.copy(src, dst, follow_symlinks=False)
+                if executor is not None:
+                    executor.copy(src, dst)
+                elif copier is not None:
+                    copier.copy(src, dst)
+                else:
+                    newPath = shutil.copy(src, dst, follow_symlinks=False)
+
+    if executor is not None:
+        failures = executor.wait()
+        for action, path, e in failures:
+            print('failed to {} {}: {}'.format(action, path, e))
+        if failures:
+            return filenames, destination_filepaths, failures
 
     if verbose:
         print("Successfully updated JARs")
 
-    return filenames, destination_filepaths
+    return filenames, destination_filepaths, []
+
+def build_deploy_plan(repo, base, target, output_dst=None, gitdir=GIT_REPO_DIR, branch_name=BRANCH_NAME, jar_rootdir='.'):
+	'''
+	Does the analysis of a deploy without changing anything: diff, filter, classification, ant target selection and
+	jar destinations.
+	:param target: commit SHA to plan the deploy of
+	:param jar_rootdir: dir the jar fan-out searches, the destinations are saved relative to it
+	:return: plan dictionary, see deployPlan.py
+	'''
+	jar_targets = set()
+	# Destinations relative to the dst root, apply puts them under the live dir or a staged release
+	classifier = get_path_classifier(branch_name, '')
+	deploy_filter = get_deploy_filter(repo, target, branch_name)
+	changes = iter_filtered_changes(iter_git_changes(repo, base, target, output_dst=output_dst), deploy_filter, repo)
+	pairs = {'A': [], 'M': [], 'R': [], 'D': []}
+	for letter, src, dst in iter_deploy_pairs(changes, dst_root='', gitdir=gitdir, branch_name=branch_name, jar_targets=jar_targets, classifier=classifier):
+		pairs[letter].append([src, dst])
+
+	ant_targets = select_ant_targets(jar_targets)
+	jar_fanout = {}
+	if ant_targets:
+		jar_filenames = [os.path.basename(p) for p in getJarFilesFullSrcPaths(LOCAL_GIT_JAR_DIR_PATH)]
+		for fname, dsts in findPathsToAllJars(jar_filenames, rootdir=jar_rootdir).items():
+			jar_fanout[fname] = [os.path.relpath(dst, jar_rootdir) for dst in dsts]
+	return makePlan(branch_name, base, target, pairs, ant_targets, jar_fanout,
+		filtered=(deploy_filter.filtered_files, deploy_filter.filtered_bytes))
+
+def planned_jar_destinations(plan, rootdir):
+	# findPathsToAllJars for a plan: the destinations were found when the plan was made, no search here
+	return {fname: [os.path.join(rootdir, rel_dst) for rel_dst in rel_dsts] for fname, rel_dsts in plan['jar_fanout'].items()}
+
+def fan_out_jars(src_paths, destinations, executor, dry_run=False):
+	'''
+	replaceOldJARs for jars/wars whose destinations are already known, without waiting for the copies.
+	:param destinations: dictionary mapping each jar/war filename to its destination paths
+	:return: the executor's copy ops, to wait on
+	'''
+	ops = []
+	for src in src_paths:
+		for dst in destinations.get(os.path.basename(src), []):
+			if VERBOSE:
+				logger.info('src: {} | dst: {}'.format(src, dst))
+			if not dry_run:
+				ops.append(executor.copy(src, dst, label='jar_fanout'))
+	return ops
+
+def git_blob_sha(path):
+	# Same id `git hash-object` gives the file, without a git process
+	h = hashlib.sha1(b'blob %d\0' % os.path.getsize(path))
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def stage_jar_changes(repo, jar_dir=LOCAL_GIT_JAR_DIR_PATH):
+	'''
+	Stages the jars/wars in jar_dir that differ from the index, instead of a `git add .` over the whole work tree.
+	Other files in jar_dir (i.e. Clarinet.toml, *.ts, *.txt) are left alone.
+	Files whose size and mtime match their index entry are taken as unchanged, the others are hashed to be sure.
+	:return: (repo relative paths added or updated, repo relative paths removed)
+	'''
+	index = repo.index
+	rel_dir = os.path.relpath(os.path.abspath(jar_dir), repo.working_tree_dir).replace(os.sep, '/')
+	tracked = {}
+	for (path, stage), entry in index.entries.items():
+		if stage == 0 and path.rsplit('/', 1)[0] == rel_dir and path.lower().endswith(JAR_FILE_EXTENSIONS):
+			tracked[path] = entry
+
+	changed = []
+	for entry in os.scandir(jar_dir):
+		if not entry.is_file(follow_symlinks=False) or not entry.name.lower().endswith(JAR_FILE_EXTENSIONS):
+			continue
+		path = rel_dir + '/' + entry.name
+		indexed = tracked.pop(path, None)
+		if indexed is not None:
+			st = entry.stat()
+			if indexed.size == st.st_size and indexed.mtime == (int(st.st_mtime), st.st_mtime_ns % 1000000000):
+				continue
+			if indexed.hexsha == git_blob_sha(entry.path):
+				continue
+		changed.append(path)
+	removed = sorted(tracked)
+
+	if removed:
+		index.remove(removed)
+	if changed:
+		index.add(changed)
+	return changed, removed
+
+def commit_jar_changes(repo, dry_run=False):
+	'''
+	Jars created inside the VM's gitrepo are committed and pushed so they are also in code cloud.
+	:return: True if there was anything to commit
+	'''
+	if dry_run:
+		logger.info('dry run: .jar/.war changes are not committed or pushed')
+		return False
+	with metrics.phase('jar_commit'):
+		changed, removed = stage_jar_changes(repo)
+	metrics.record('jar_commit', files=len(changed) + len(removed))
+	if not changed and not removed:
+		logger.info('no .jar/.war changes to commit')
+		return False
+	now = datetime.utcnow()
+	jar_last_updated = str(now).split('.')[0] # Gets current time and date in str format
+	msg = "Updated .jars and .war based on latest changes to source code at {} UTC".format(jar_last_updated)
+	with metrics.phase('jar_commit'):
+		commit = repo.index.commit(msg)
+	logger.info('committed {} changed and {} removed .jar/.war files as {}'.format(len(changed), len(removed), commit.hexsha[:12]))
+	try:
+		with metrics.phase('push'):
+			repo.git.push()
+	except git.GitCommandError as e:
+		# The commit stays, the next successful push takes it along
+		logger.error('git push failed: {}'.format(e))
+	return True
 
 def getJarFilesFullSrcPaths(gitrepo_dir):
     jar_files_source_paths = []
@@ -364,9 +830,587 @@ def getJarFilesFullSrcPaths(gitrepo_dir):
     return jar_files_source_paths
 
 
+def new_release_id(commit):
+	return '{}_{}'.format(commit[:12], datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+def releases_dir_for(name):
+	return os.path.join(RELEASES_DIR, name)
+
+def start_staged_release(live_root, name, commit):
+	'''
+	:param live_root: dst_root of the deploy, the live app dir
+	:param name: branch or site the release is for
+	:return: StagedRelease linked from the live one, its root is the dst_root to deploy the changes to
+	'''
+	release = StagedRelease(live_root, releases_dir_for(name), new_release_id(commit))
+	with metrics.phase('stage'):
+		release.prepare()
+	metrics.record('stage', files=release.linked_files)
+	return release
+
+def finish_staged_release(release, repo, deployed_commit, failed):
+	'''
+	Swaps the release in, or drops it when any file failed. The live app then stays on the old release, so the repo is
+	reset to the deployed commit as well and the next run diffs (and retries) the same changes.
+	:return: True if the release went live
+	'''
+	if failed:
+		logger.error('not going live with {}, live app dir left as it was'.format(release.path))
+		release.abort()
+		repo.head.reset(deployed_commit, index=True, working_tree=True)
+		return False
+	with metrics.phase('cutover'):
+		release.cutover()
+	logger.info(release.report())
+	return True
+
+def reset_failed_in_place(repo, deployed_commit):
+	'''
+	An in place deploy that failed leaves some files of the new commit live, the repo goes back to the deployed commit
+	anyway so the next run (or watch's next poll) diffs and places the same changes again.
+	'''
+	logger.error('deploy failed, repo reset to {} so the next run retries it'.format(deployed_commit[:12]))
+	repo.head.reset(deployed_commit, index=True, working_tree=True)
+
+
+def site_deploy_paths(repo, commit, branch_name=BRANCH_NAME):
+	'''
+	:return: top level entries the site dir of branch_name deploys into, the parts of an in place dst_root that are recorded
+	'''
+	try:
+		site_tree = repo.commit(commit).tree / 'site_specific/{}'.format(branch_name)
+	except KeyError:
+		return []
+	return [item.name for item in site_tree]
+
+def record_release(name, release_id, root, repo, hash_cache, paths=None, changed=None):
+	'''
+	Saves what is live for name in the release store, so it can be rolled back to later.
+	:param root: the release dir of a staged deploy, or the dst_root of an in place one (only paths under it are recorded)
+	:param changed: paths an in place deploy touched (PlacementExecutor.touched), the live manifest is updated with
+		just these instead of walking root
+	'''
+	store = ReleaseStore(RELEASE_STORE_DIR, name, hash_cache=hash_cache, link_objects=STAGED_DEPLOY)
+	with metrics.phase('record'):
+		if changed is not None:
+			store.recordChanges(release_id, root, repo.head.commit.hexsha, changed, paths=paths)
+		else:
+			store.record(release_id, root, repo.head.commit.hexsha, paths=paths)
+	metrics.record('record', files=store.stored_objects, nbytes=store.stored_bytes)
+	logger.info(store.report())
+	return store
+
+def write_metrics(runs):
+	'''
+	:param runs: dictionary mapping each deploy (branch or site) to its Metrics.toDict()
+	'''
+	try:
+		if METRICS_JSON_PATH:
+			writeMetricsJson(METRICS_JSON_PATH, runs)
+		if METRICS_TEXTFILE_PATH:
+			writeMetricsTextfile(METRICS_TEXTFILE_PATH, runs)
+	except OSError as e:
+		# Never worth failing a deploy over
+		logger.warning('could not write metrics: {}'.format(e))
+
+def gc_releases(store):
+	# Only run while no deploy is recording, an object stored for a manifest that isn't written yet looks unused
+	with metrics.phase('gc'):
+		dropped = store.gc(RELEASE_RETENTION)
+	for name, release_ids in dropped.items():
+		for release_id in release_ids:
+			logger.info('dropped release {} of {}'.format(release_id, name))
+			shutil.rmtree(os.path.join(releases_dir_for(name), release_id), ignore_errors=True)
+	logger.info('Release store: removed {} unused objects'.format(store.removed_objects))
+
+def rollback_release(name, live_root, gitdir, release_id=None):
+	'''
+	Puts a release recorded earlier back from the release store. Nothing is fetched, diffed or built.
+	:param release_id: release to go back to, the one before the live one when None
+	:return: id of the release that is live now
+	'''
+	store = ReleaseStore(RELEASE_STORE_DIR, name, link_objects=STAGED_DEPLOY)
+	release_id = release_id or store.previous()
+	if release_id is None:
+		raise ValueError('no earlier release of {} to roll back to'.format(name))
+	manifest = store.load(release_id)
+
+	if STAGED_DEPLOY:
+		release = StagedRelease(live_root, releases_dir_for(name), release_id)
+		if os.path.isdir(release.path):
+			store.setCurrent(release_id)
+		else:
+			# Its release dir was dropped already, link one from the live release and put back what differs
+			release.prepare()
+			store.restore(release_id, release.path)
+		release.cutover()
+	else:
+		counts = store.restore(release_id, live_root)
+		logger.info('{}: restored {} files, removed {}'.format(release_id, counts['restored'], counts['removed']))
+
+	# The repo follows what's live, so the next deploy diffs from the rolled back commit
+	repo = Repo(gitdir)
+	rolled_away = repo.head.commit.hexsha
+	repo.head.reset(manifest['commit'], index=True, working_tree=True)
+	if rolled_away != manifest['commit']:
+		# watch would see the remote ahead of HEAD again and put the bad commit back, see watch_branch
+		store.setRolledBack(rolled_away)
+	logger.info('{} rolled back to {} (commit {})'.format(name, release_id, manifest['commit']))
+	return release_id
+
+def release_targets(sites=None):
+	'''
+	:param sites: site branches, the single branch deploy (BRANCH_NAME into ROOT_DIR) when None
+	:return: list of (name, live dst_root, git dir) for rollback and listing releases
+	'''
+	if sites is None:
+		return [(BRANCH_NAME, ROOT_DIR, GIT_REPO_DIR)]
+	dst_roots = site_dst_roots(sites)
+	return [(site, dst_roots[site], os.path.join(SITE_WORKTREES_DIR, site)) for site in sites]
+
+def site_dst_roots(sites):
+	'''
+	Sites deploy side by side, so each one needs a root dir no other site writes to.
+	:return: dictionary mapping each site to its root dir from SITE_DST_ROOTS
+	'''
+	missing = [site for site in sites if not SITE_DST_ROOTS.get(site)]
+	if missing:
+		raise ValueError('no root dir in SITE_DST_ROOTS for {}'.format(', '.join(missing)))
+	seen = {}
+	for site in sites:
+		root = os.path.normpath(os.path.abspath(SITE_DST_ROOTS[site]))
+		if root in seen:
+			raise ValueError('{} and {} are both deployed into {}'.format(seen[root], site, root))
+		seen[root] = site
+	return {site: SITE_DST_ROOTS[site] for site in sites}
+
+
+def git_fetch_sites(repo, rmt_name, branch_names):
+	# Every site branch comes down in one fetch
+	with metrics.phase('fetch'):
+		repo.remote(rmt_name).fetch(list(branch_names))
+
+def site_deployed_commit(site):
+	# Commit of the site's live release, None before its first recorded deploy
+	store = ReleaseStore(RELEASE_STORE_DIR, site)
+	release_id = store.current()
+	if release_id is None:
+		return None
+	return store.load(release_id)['commit']
+
+def site_worktree(repo, site, rmt_name=REMOTE_NAME, worktrees_dir=SITE_WORKTREES_DIR):
+	'''
+	:return: path to a checkout of the site branch. The main repo dir if it already has the branch checked out,
+		otherwise a git worktree under worktrees_dir (created on first use).
+	'''
+	if not repo.head.is_detached and repo.active_branch.name == site:
+		return repo.working_tree_dir
+	# Absolute since git runs the worktree command from inside the repo dir
+	path = os.path.abspath(os.path.join(worktrees_dir, site))
+	if not os.path.isdir(path):
+		if site in repo.heads:
+			repo.git.worktree('add', path, site)
+		else:
+			# The deploy diffs from the worktree's HEAD, so it has to start at what the site runs now. Starting at
+			# the remote branch would leave nothing to deploy.
+			deployed_commit = site_deployed_commit(site)
+			if deployed_commit is None:
+				raise RuntimeError('no deployed commit recorded for {}: create the branch at the commit the site runs '
+					'(git branch {} <commit>) or deploy it in full first'.format(site, site))
+			repo.git.worktree('add', '-b', site, path, deployed_commit)
+	return path
+
+def deploy_site(site, gitdir, dst_root, output_dst, rmt_name=REMOTE_NAME, dry_run=False):
+	'''
+	Diffs, merges and deploys the site specific files of one site branch. Runs in its own process from deploy_sites,
+	after the branch was already fetched.
+	:return: dictionary with the site's change counts, jar targets with source changes, per file failures and copy report
+	'''
+	# Worker processes are reused between sites, each site's phases start from zero
+	metrics.reset()
+	repo = Repo(gitdir)
+	os.makedirs(output_dst, exist_ok=True)
+	deployed_commit = repo.head.commit.hexsha
+	rmt_branch = '{}/{}'.format(rmt_name, site)
+	if not dry_run:
+		run_git_pull(repo=repo, rmt_name=rmt_name, branch_name=site, output_dst=output_dst)
+
+	live_root = dst_root
+	release = None
+	if STAGED_DEPLOY and not dry_run:
+		release = start_staged_release(live_root, site, repo.commit(rmt_branch).hexsha)
+		dst_root = release.root
+
+	# Each site keeps its own hash cache so the worker processes never write the same file
+	copier = FileCopier(skip_unchanged=SKIP_UNCHANGED, hash_cache_path=os.path.join(output_dst, HASH_CACHE_PATH), strategies=PLACEMENT_STRATEGIES,
+		delta_min_size=DELTA_MIN_SIZE, replace_links=release is not None)
+	executor = PlacementExecutor(max_workers=COPY_WORKERS, copier=copier, metrics=metrics)
+	counts, jar_targets, deploy_filter = deploy_branch_changes(repo, deployed_commit, rmt_branch, output_dst,
+		executor=executor, dst_root=dst_root, gitdir=gitdir, branch_name=site, dry_run=dry_run)
+
+	result = {
+		'site': site,
+		'changes': counts,
+		'jar_targets': sorted(jar_targets),
+		'failures': [],
+		'copy_report': None,
+		'filter_report': deploy_filter.report(),
+		'release': None,
+		'metrics': None,
+	}
+	with metrics.phase('deploy_wait'):
+		failures = executor.wait()
+	for action, path, e in failures:
+		result['failures'].append((action, path, str(e)))
+	executor.shutdown()
+	if release is not None:
+		if finish_staged_release(release, repo, deployed_commit, bool(result['failures'])):
+			result['release'] = release.release_id
+			record_release(site, release.release_id, release.path, repo, copier.hash_cache)
+	elif result['failures'] and not dry_run:
+		reset_failed_in_place(repo, deployed_commit)
+	elif not dry_run:
+		result['release'] = new_release_id(repo.head.commit.hexsha)
+		record_release(site, result['release'], live_root, repo, copier.hash_cache,
+			paths=site_deploy_paths(repo, repo.head.commit.hexsha, site), changed=executor.touched)
+	copier.save()
+	result['copy_report'] = copier.report()
+	metrics.ok = not result['failures']
+	result['metrics'] = metrics.toDict()
+	return result
+
+def deploy_sites(repo, sites, working_dir, rmt_name=REMOTE_NAME, dry_run=False):
+	'''
+	Fetches every site branch once, then deploys each site in its own worker process.
+	:return: dictionary mapping each site to its deploy_site result (or {'site', 'error'} if the worker failed or the
+		site has no worktree)
+	'''
+	dst_roots = site_dst_roots(sites)
+	git_fetch_sites(repo, rmt_name, sites)
+	# Worktrees are set up here, one at a time, since adding one writes to the shared repo
+	results = {}
+	worktrees = {}
+	for site in sites:
+		try:
+			worktrees[site] = site_worktree(repo, site, rmt_name=rmt_name)
+		except (RuntimeError, git.GitCommandError) as e:
+			logger.error('{}: {}'.format(site, e))
+			results[site] = {'site': site, 'error': str(e)}
+
+	with ProcessPoolExecutor(max_workers=max(1, len(worktrees))) as pool:
+		futures = {}
+		for site in worktrees:
+			fut = pool.submit(deploy_site, site, worktrees[site], dst_roots[site],
+				os.path.join(working_dir, site), rmt_name, dry_run)
+			futures[fut] = site
+		for fut in as_completed(futures):
+			site = futures[fut]
+			try:
+				results[site] = fut.result()
+			except Exception as e:
+				results[site] = {'site': site, 'error': str(e)}
+	if not dry_run and sites:
+		# Every site has recorded its release by now
+		gc_releases(ReleaseStore(RELEASE_STORE_DIR, sites[0]))
+	# The fetch, worktrees and gc are this process' phases, the rest happened in the workers
+	runs = {'sites': metrics.toDict()}
+	for site, result in results.items():
+		if result.get('metrics'):
+			runs[site] = result['metrics']
+	write_metrics(runs)
+	return results
+
+
+def deploy_branch(gr, working_dir, rmt_branch, plan=None, hash_cache=None):
+	'''
+	Deploys BRANCH_NAME into ROOT_DIR once the remote branch was fetched, or runs a plan (see deployPlan.py).
+	The steps run as a task graph (see taskGraph.py): site files are copied while ant builds, and the jars/wars of an
+	ant invocation are fanned out as soon as it finished.
+	:param rmt_branch: what to deploy, the fetched remote branch or the plan's target commit
+	:param hash_cache: copyEngine.HashCache kept between deploys (watch), loaded from HASH_CACHE_PATH when None
+	:return: True when every file was placed and every ant target built
+	'''
+	# The diff runs from the commit deployed so far to the fetched branch, so it can be read after the merge
+	deployed_commit = gr.head.commit.hexsha
+	target_commit = gr.commit(rmt_branch).hexsha
+
+	# With STAGED_DEPLOY everything below goes into a new release dir, the live app dir only changes at the cutover
+	release = None
+	dst_root = ROOT_DIR
+	if STAGED_DEPLOY and not DRY_RUN:
+		release = start_staged_release(ROOT_DIR, BRANCH_NAME, target_commit)
+		dst_root = release.root
+	# A staged release gets its jars before it goes live
+	jar_rootdir = release.path if release else '.'
+
+	# Skips rewriting destinations that already hold the same bytes when SKIP_UNCHANGED is set
+	copier = FileCopier(skip_unchanged=SKIP_UNCHANGED, hash_cache_path=HASH_CACHE_PATH, strategies=PLACEMENT_STRATEGIES,
+		delta_min_size=DELTA_MIN_SIZE, replace_links=release is not None, hash_cache=hash_cache)
+
+	# Copies/moves/deletes run concurrently, ops on the same path keep the order they come out of the diff in
+	executor = PlacementExecutor(max_workers=COPY_WORKERS, copier=copier, metrics=metrics)
+
+	graph = TaskGraph(DEPLOY_GRAPH_WORKERS)
+	after_merge = []
+	if not DRY_RUN:
+		# Merge the changes so the files can be copied
+		graph.add('merge', lambda: run_git_pull(repo=gr, rmt_name=REMOTE_NAME, branch_name=BRANCH_NAME, output_dst=working_dir,
+			target=plan['target'] if plan else None))
+		after_merge = ['merge']
+
+	def site_files():
+		if plan is not None:
+			with metrics.phase('deploy_queue'):
+				deployed_counts = deploy_change_stream(metrics.iterPhase('prepare', iterPlanPairs(plan, dst_root)), executor=executor, dry_run=DRY_RUN)
+		else:
+			# Reviewing and deploying updates, one changed file at a time...
+			deployed_counts, _, deploy_filter = deploy_branch_changes(gr, deployed_commit, rmt_branch, working_dir,
+				executor=executor, dst_root=dst_root, dry_run=DRY_RUN)
+			logger.info(deploy_filter.report())
+		with metrics.phase('deploy_wait'):
+			failures = executor.wait()
+		for action, path, e in failures:
+			logger.error('failed to {} {}: {}'.format(action, path, e))
+		logger.info('Site specific changes (dry run: {}): {}'.format(DRY_RUN, deployed_counts))
+		return deployed_counts
+
+	graph.add('site_files', site_files, deps=after_merge)
+
+	# Jar/war side: ant_targets adds one ant task per invocation, a fan-out task per invocation whose artifacts are
+	# known (ANT_TARGET_ARTIFACTS), then the rest of the jar dir and the commit once every build succeeded
+	ant = {}
+	ant_results = {}
+	ant_slots = threading.Semaphore(ANT_MAX_PARALLEL)
+	fanned_out = set()
+	fanned_out_lock = threading.Lock()
+
+	def jar_index():
+		# After the site files, so the search sees the tree as it is deployed
+		with metrics.phase('jar_index'):
+			if plan is not None:
+				destinations = planned_jar_destinations(plan, jar_rootdir)
+			else:
+				jar_filenames = [os.path.basename(p) for p in getJarFilesFullSrcPaths(LOCAL_GIT_JAR_DIR_PATH)]
+				destinations = findPathsToAllJars(jar_filenames, rootdir=jar_rootdir, moved_root=release is not None)
+		metrics.record('jar_index', files=sum(len(dsts) for dsts in destinations.values()))
+		return destinations
+
+	def place_jars(src_paths):
+		with fanned_out_lock:
+			src_paths = [p for p in src_paths if p not in fanned_out and os.path.isfile(p)]
+			fanned_out.update(src_paths)
+		# Setting VERBOSE = True will print each pair of source and destination locations involved with the JAR updates
+		ops = fan_out_jars(src_paths, graph.result('jar_index'), executor, dry_run=DRY_RUN)
+		with metrics.phase('jar_fanout_wait'):
+			wait(ops)
+		failed = [op.exception() for op in ops if op.exception() is not None]
+		for e in failed:
+			logger.error('failed to place jar: {}'.format(e))
+		if failed:
+			# Fails the task, so the jar commit doesn't run
+			raise RuntimeError('{} of {} jar/war copies failed'.format(len(failed), len(ops)))
+		return len(src_paths)
+
+	def ant_invocation(group):
+		def build():
+			xml_path = ant_xml_path()
+			if ant['dry_run']:
+				logger.info(' '.join(antCommand(group, xml_path)))
+				return
+			with ant_slots:
+				results = runAntInvocation(group, xml_path)
+			ant_results.update(results)
+			print_ant_results(group, results)
+			failed = [t for t in group if results[t]['exit_code'] != 0]
+			if failed:
+				# Don't place the jars of a failed build
+				raise RuntimeError('ant build failed for: {}'.format(', '.join(failed)))
+			for target in group:
+				if target in ANT_TARGET_ARTIFACTS and ant['keys'][target] is not None:
+					ant['build_cache'].store(ant['keys'][target], ant_build_artifacts(target, ant['before']))
+		return build
+
+	def rest_of_jars():
+		# Everything in the jar dir no earlier task placed, i.e. the output of targets missing from ANT_TARGET_ARTIFACTS
+		src_paths = [p for p in getJarFilesFullSrcPaths(LOCAL_GIT_JAR_DIR_PATH) if p not in fanned_out]
+		destinations = graph.result('jar_index')
+		missing = [os.path.basename(p) for p in src_paths if os.path.basename(p) not in destinations]
+		if plan is None and missing:
+			# Built for the first time after the index was read, the jar manifest keeps this a short lookup
+			with metrics.phase('jar_index'):
+				destinations.update(findPathsToAllJars(missing, rootdir=jar_rootdir, moved_root=release is not None))
+		return place_jars(src_paths)
+
+	def ant_targets():
+		# Own Repo: GitPython's cat-file processes can't be shared with the site_files thread
+		build_repo = Repo(gr.working_tree_dir)
+		if plan is not None:
+			targets = plan['ant_targets']
+		else:
+			# Only the targets whose source changed, plus the ones depending on them (ANT_TARGET_DEPENDENCIES)
+			targets = select_ant_targets(changed_jar_targets(build_repo, deployed_commit, target_commit))
+		if not targets:
+			return []
+		logger.info("Creating New .jar/.war Files Based on Changes to Source Code")
+
+		ant['dry_run'] = DRY_RUN
+		ant['build_cache'] = BuildCache(BUILD_CACHE_DIR, max_bytes=BUILD_CACHE_MAX_BYTES)
+		ant['keys'], ant['to_build'], restored = restore_cached_builds(targets, build_repo, ant['build_cache'], dry_run=ant['dry_run'])
+		ant['before'] = snapshot_jar_dir()
+
+		graph.add('jar_index', jar_index, deps=['site_files'])
+		jar_tasks = ['jar_index']
+		if restored:
+			graph.add('jars:cached', lambda: place_jars(restored), deps=['jar_index'])
+			jar_tasks.append('jars:cached')
+		ant_tasks = []
+		for group in group_ant_targets(ant['to_build']):
+			name = '+'.join(group)
+			graph.add('ant:' + name, ant_invocation(group), deps=['ant_targets'])
+			ant_tasks.append('ant:' + name)
+			artifacts = [os.path.join(LOCAL_GIT_JAR_DIR_PATH, fname) for target in group for fname in ANT_TARGET_ARTIFACTS.get(target, [])]
+			if artifacts:
+				graph.add('jars:' + name, lambda artifacts=artifacts: place_jars(artifacts), deps=['ant:' + name, 'jar_index'])
+				jar_tasks.append('jars:' + name)
+		graph.add('jars:rest', rest_of_jars, deps=ant_tasks + jar_tasks)
+		# Added in commit and push once above is finished so that jars created inside the VM's gitrepo are also in code cloud
+		graph.add('commit_jars', lambda: commit_jar_changes(gr, dry_run=DRY_RUN), deps=['jars:rest'])
+		return targets
+
+	graph.add('ant_targets', ant_targets, deps=after_merge)
+	states = graph.run()
+
+	failed_ant_targets = [t for t, res in ant_results.items() if res['exit_code'] != 0]
+	if failed_ant_targets:
+		logger.error('ant build failed for: {}'.format(', '.join(failed_ant_targets)))
+		logger.warning('skipping jar replacement for them and the jar commit')
+	if 'build_cache' in ant:
+		built = [t for t in ant['to_build'] if ant_results.get(t, {}).get('exit_code') == 0 and ant['keys'][t] is not None]
+		store_unmapped_build(built, ant['keys'], ant['before'], ant['build_cache'])
+		ant['build_cache'].save()
+		logger.info(ant['build_cache'].report())
+	# Ant failures are reported above, anything else failing (merge, diff, jar search) fails the deploy
+	failed_steps = [name for name, state in states.items() if state == FAILED and not name.startswith('ant:')]
+
+	# Whatever failed after the site files were waited on (the jar copies log their own)
+	for action, path, e in executor.wait():
+		logger.error('failed to {} {}: {}'.format(action, path, e))
+	executor.shutdown()
+	failed = executor.failure_count > 0 or bool(failed_steps)
+	went_live = True
+	if release is not None:
+		went_live = finish_staged_release(release, gr, deployed_commit, failed)
+	elif failed and not DRY_RUN:
+		reset_failed_in_place(gr, deployed_commit)
+	if not DRY_RUN and went_live and not failed:
+		# Recorded after the jar commit, so rolling back to it resets the repo to a commit with these jars
+		if release is not None:
+			release_store = record_release(BRANCH_NAME, release.release_id, release.path, gr, copier.hash_cache)
+		else:
+			release_store = record_release(BRANCH_NAME, new_release_id(gr.head.commit.hexsha), ROOT_DIR, gr, copier.hash_cache,
+				paths=site_deploy_paths(gr, gr.head.commit.hexsha), changed=executor.touched)
+		gc_releases(release_store)
+	logger.info(copier.report())
+	copier.save()
+	logger.info(graph.report())
+	metrics.ok = executor.failure_count == 0 and not failed_ant_targets and not failed_steps
+	logger.info(metrics.report())
+	write_metrics({BRANCH_NAME: metrics.toDict()})
+	return metrics.ok
+
+
+def watch_branch(gr, working_dir):
+	'''
+	Deploys every new commit of the remote branch until SIGTERM/SIGINT. gr, the path classifier, the jar manifest, the
+	hash cache and GitPython's git processes stay loaded between deploys.
+	'''
+	rmt_branch = '{}/{}'.format(REMOTE_NAME, BRANCH_NAME)
+	# Read once, each deploy saves it again when it hashed anything
+	hash_cache = HashCache(HASH_CACHE_PATH)
+
+	def poll():
+		# A deploy's metrics start with the fetch that found its commit
+		metrics.reset()
+		git_fetch(repo=gr, output_dst=working_dir, rmt_name=REMOTE_NAME, branch_name=BRANCH_NAME)
+		return gr.commit(rmt_branch).hexsha
+
+	def is_deployed(sha):
+		return gr.is_ancestor(sha, gr.head.commit.hexsha)
+
+	def is_held(sha):
+		# After a rollback only a commit past the rolled back one is deployed, a manual deploy can still force it
+		store = ReleaseStore(RELEASE_STORE_DIR, BRANCH_NAME)
+		rolled_back = store.rolledBack()
+		if rolled_back is None:
+			return False
+		if gr.is_ancestor(sha, rolled_back):
+			return True
+		logger.info('{} moved past the rolled back {}, deploying again'.format(rmt_branch, rolled_back[:12]))
+		store.clearRolledBack()
+		return False
+
+	def deploy(sha):
+		# The commit poll saw, the remote ref doesn't move again before the next poll
+		write_git_output(working_dir, 'prev_git_status.txt', gr.git.status())
+		return deploy_branch(gr, working_dir, sha, hash_cache=hash_cache)
+
+	watcher = Watcher(poll, is_deployed, deploy, WATCH_INTERVAL, debounce=WATCH_DEBOUNCE, max_backoff=WATCH_MAX_BACKOFF,
+		is_held=is_held)
+	server = startHealthServer(watcher, WATCH_STATUS_ADDRESS)
+	for signum in (signal.SIGTERM, signal.SIGINT):
+		signal.signal(signum, lambda *_: watcher.stop())
+	logger.info('watching {} every {}s, status on http://{}:{}/status'.format(rmt_branch, WATCH_INTERVAL, *WATCH_STATUS_ADDRESS))
+	try:
+		watcher.run()
+	finally:
+		server.shutdown()
+
 
 if __name__ == "__main__":
 	# Gather, review, and deploy updates from CodeCloud
+	parser = argparse.ArgumentParser()
+	parser.add_argument('command', nargs='?', default='deploy', choices=['deploy', 'plan', 'apply', 'watch', 'rollback', 'releases'],
+		help='deploy (default), plan a deploy into --plan, apply the plan in --plan, watch the remote and deploy every new commit, '
+			'rollback to an earlier release, or list the recorded releases')
+	parser.add_argument('--sites', nargs='*', metavar='SITE', help='deploy several site branches from one fetch (SITE_BRANCHES when none are given)')
+	parser.add_argument('--plan', default=DEPLOY_PLAN_PATH, help='plan file written by plan and run by apply')
+	parser.add_argument('--release', help='release id to roll back to, the one before the live release when not given')
+	parser.add_argument('--log-level', default=LOG_LEVEL, help='DEBUG, INFO, WARNING or ERROR')
+	parser.add_argument('--profile', metavar='PATH', help='run the deploy under cProfile and save the stats to PATH (see deployMetrics.py)')
+	args = parser.parse_args()
+	# Only this script's loggers follow --log-level, GitPython's stay at WARNING
+	logging.basicConfig(format='%(message)s')
+	for logger_name in ('deployCode', 'copyEngine', 'stagedRelease', 'deployWatcher', 'taskGraph', 'deployMetrics'):
+		logging.getLogger(logger_name).setLevel(args.log_level.upper())
+
+	if args.sites is not None:
+		try:
+			site_dst_roots(args.sites or SITE_BRANCHES)
+		except ValueError as e:
+			logger.error('refusing to run for sites: {}'.format(e))
+			sys.exit(1)
+
+	if args.command in ('rollback', 'releases'):
+		targets = release_targets(None if args.sites is None else args.sites or SITE_BRANCHES)
+		for name, live_root, gitdir in targets:
+			if args.command == 'rollback':
+				rollback_release(name, live_root, gitdir, release_id=args.release)
+				continue
+			store = ReleaseStore(RELEASE_STORE_DIR, name)
+			current = store.current()
+			for release_id, created, commit in store.releases():
+				print('{} {} {} {}{}'.format(name, release_id, commit[:12], datetime.utcfromtimestamp(created).strftime('%Y-%m-%d %H:%M:%S'),
+					' (live)' if release_id == current else ''))
+		sys.exit(0)
+
+	if args.sites is not None:
+		sites = args.sites or SITE_BRANCHES
+		# Only this process is profiled, the sites deploy in worker processes
+		with profiled(args.profile):
+			site_results = deploy_sites(Repo(GIT_REPO_DIR), sites, os.getcwd(), rmt_name=REMOTE_NAME, dry_run=DRY_RUN)
+		for site in sites:
+			pprint(site_results[site])
+		sys.exit(1 if any(r.get('error') or r.get('failures') for r in site_results.values()) else 0)
 
 	# Gathering...
 	cwd = os.getcwd()
@@ -381,96 +1425,34 @@ if __name__ == "__main__":
 	# gr = Repo(GIT_REPO_DIR)
 	working_dir = os.getcwd()
 
-	os.system('cd {} && git status > {}/prev_git_status.txt'.format(GIT_REPO_DIR, working_dir))
-	git_fetch(output_dst=working_dir, rmt_name=REMOTE_NAME, branch_name=BRANCH_NAME, gitdir=GIT_REPO_DIR)
-
-	# Reviewing changes...
-	diff_local_vs_remote_paths, diff_objects = git_diff(repo=gr, output_dst=working_dir,rmt_name=REMOTE_NAME, branch_name=BRANCH_NAME, gitdir=GIT_REPO_DIR)
-	src_dst_pairs_dict = prepare_to_deploy_changes(diff_objects,dst_root=ROOT_DIR, dry_run=DRY_RUN)
-
-	# Call check_for_jar_src_code_changes based on current src_dst_pair_dict, WITHOUT any filtering that avoids placement on app VM
-	found_changes_to_jar_src_code = check_for_jar_src_code_changes(src_dst_pairs_dict)
-
-	change_type_keys = list(src_dst_pairs_dict.keys())
-	non_jar_related_src_dst_pairs_dict = {}
-	for letter in change_type_keys:
-		new_src_dst_pair_list = []
-		old_stc_dst_pair_list = src_dst_pairs_dict[letter]
-		for src_dst_pair in old_stc_dst_pair_list:
-			src, dst = src_dst_pair
-			if check_if_src_path_is_related_to_jar_source_code(apath=src) != -1: #-1 when it finds a path to jar source code in the string
-				# If not, add it to the list of files to copy their paths directly.
-				new_src_dst_pair_list.append((src, dst))
-		non_jar_related_src_dst_pairs_dict[letter] = new_src_dst_pair_list
-
-
-	if not DRY_RUN:
-		# Merge the changes so the files can be copied
-		run_git_pull()
-
-		# Deploying updates...
-		try:
-			deploy_changes_for_A_or_M(non_jar_related_src_dst_pairs_dict,letter='A', dry_run=DRY_RUN)
-		except:
-			e = sys.exc_info()[0]
-			print(str(e))
-			print('failed to update ADDED files')
-
-		try:
-			deploy_changes_for_A_or_M(non_jar_related_src_dst_pairs_dict,letter='M', dry_run=DRY_RUN)
-		except:
-			e = sys.exc_info()[0]
-			print(str(e))
-
-			print('failed to update MODIFIED files')
-
-		try:
-			deploy_changes_for_R(non_jar_related_src_dst_pairs_dict, dry_run=DRY_RUN)
-		except:
-			e = sys.exc_info()[0]
-			print(str(e))
-
-			print('failed to migrate RENAMED files')
-
-		try:
-			deploy_changes_for_D(non_jar_related_src_dst_pairs_dict, dry_run=DRY_RUN)
-		except:
-			e = sys.exc_info()[0]
-			print(str(e))
-			print('failed to DELETE the files removed')
-
-
-	# pprint(src_dst_pairs_dict)
-
-
-	# Ant Build to create new Jars
-	if found_changes_to_jar_src_code:
-		print("\n")
-		print("Creating New .jar/.war Files Based on Changes to Source Code")
-
-		# TODO: Change these inputs to DRY_RUN instead of True
-		ant_build(jarname='ewo', dry_run=True)
-		ant_build(jarname='cic', dry_run=True)
-		ant_build(jarname='aotl-project', dry_run=True)
-		ant_build(jarname='aotx-secure', dry_run=True)
-		ant_build(jarname='aotlservlet', dry_run=True)
-		ant_build(jarname='aotxreports', dry_run=True)
-
-
-		# Call function to move all jars/war file in right repo. (Including inside gitrepo dir!)
-		jar_files_src_paths = getJarFilesFullSrcPaths(LOCAL_GIT_JAR_DIR_PATH)
-		# Setting verbose = True will print each pair of source and destination locations involved with the JAR updates
-		# Setting dryrun = True will do everything the same except the final step of actually copying the files over
-		jar_filenames, jar_dst_filepaths = replaceOldJARs(jar_files_src_paths, verbose=VERBOSE, dryrun=DRY_RUN)
-
-		# Added in commit and push once above is finished so that jars created inside the VM's gitrepo are also in code cloud
-		now = datetime.utcnow()
-		jar_last_updated = str(now).split('.')[0] # Gets current time and date in str format
-		msg = "Updated .jars and .war based on latest changes to source code at {} UTC".format(jar_last_updated)
-		os.system('cd {} && git add . && git commit -m "{}"'.format(GIT_REPO_DIR, msg))
-		os.system('git push')
+	rmt_branch = '{}/{}'.format(REMOTE_NAME, BRANCH_NAME)
+	plan = None
+	if args.command == 'plan':
+		git_fetch(repo=gr, output_dst=working_dir, rmt_name=REMOTE_NAME, branch_name=BRANCH_NAME)
+		plan = build_deploy_plan(gr, gr.head.commit.hexsha, gr.commit(rmt_branch).hexsha, output_dst=working_dir,
+			jar_rootdir=ROOT_DIR if STAGED_DEPLOY else '.')
+		writePlan(args.plan, plan)
+		print(planSummary(plan))
+		sys.exit(0)
+
+	if args.command == 'apply':
+		# The reviewed plan is run as it is, nothing is fetched or diffed again
+		plan = readPlan(args.plan)
+		if gr.head.commit.hexsha != plan['base']:
+			logger.error('{} was planned from {}, the repo is at {} now. Make a new plan.'.format(args.plan, plan['base'], gr.head.commit.hexsha))
+			sys.exit(1)
+		print(planSummary(plan))
+		rmt_branch = plan['target']
+	elif args.command == 'watch':
+		watch_branch(gr, working_dir)
+		sys.exit(0)
+	else:
+		write_git_output(working_dir, 'prev_git_status.txt', gr.git.status())
+		git_fetch(repo=gr, output_dst=working_dir, rmt_name=REMOTE_NAME, branch_name=BRANCH_NAME)
 
-	pprint(non_jar_related_src_dst_pairs_dict)
+	with profiled(args.profile):
+		ok = deploy_branch(gr, working_dir, rmt_branch, plan=plan)
+	sys.exit(0 if ok else 1)
 
 	# TODO: figure out where we want to want to run this file from on the app VM, make sure that doesn't break anything.
 
@@ -0,0 +1,138 @@
+# Dropping files that never belong on the app VM (Office lock files, docs, pdfs, ...) before any I/O happens
+# Rules are gitignore style and live in .deployignore files anywhere under a site dir (site_specific/<branch>),
+# on top of the default rules passed in for the whole site:
+#   *.pdf          any .pdf at any depth under the dir holding the .deployignore
+#   /docs/         the docs dir directly under that dir (trailing / only matches dirs)
+#   opt/**/tmp     patterns with a / in them are anchored to that dir, ** crosses dirs
+#   !keep.pdf      re-include something an earlier rule excluded (last matching rule wins)
+# Rules of a dir are compiled once, the first time a path in that dir is checked, and cached with whether the
+# dir itself is excluded. Paths outside the site dir are never excluded.
+
+import re
+
+DEPLOY_IGNORE_FILENAME = '.deployignore'
+
+
+def globToRegex(pattern):
+	# fnmatch.translate lets * cross '/', gitignore doesn't
+	i = 0
+	regex = ''
+	while i < len(pattern):
+		c = pattern[i]
+		if pattern.startswith('**/', i):
+			regex += '(?:.*/)?'
+			i += 3
+			continue
+		if pattern.startswith('**', i):
+			regex += '.*'
+			i += 2
+			continue
+		if c == '*':
+			regex += '[^/]*'
+		elif c == '?':
+			regex += '[^/]'
+		elif c == '[':
+			end = pattern.find(']', i + 1)
+			if end == -1:
+				regex += re.escape(c)
+			else:
+				body = pattern[i + 1:end]
+				if body.startswith('!'):
+					body = '^' + body[1:]
+				regex += '[' + body.replace('\\', '\\\\') + ']'
+				i = end
+		else:
+			regex += re.escape(c)
+		i += 1
+	return regex
+
+
+def compileRules(text, base):
+	'''
+	:param text: contents of a .deployignore (or default rules joined by newlines)
+	:param base: repo relative dir the rules are relative to
+	:return: list of (compiled regex over repo relative paths, is an include rule, only matches dirs)
+	'''
+	prefix = re.escape(base + '/') if base else ''
+	rules = []
+	for line in text.splitlines():
+		line = line.strip()
+		if not line or line.startswith('#'):
+			continue
+		negate = line.startswith('!')
+		if negate:
+			line = line[1:]
+		dir_only = line.endswith('/')
+		# Only the trailing /, a leading one still anchors the rule below
+		line = line.rstrip('/') if dir_only else line
+		if line.startswith('/') or '/' in line:
+			regex = '^' + prefix + globToRegex(line.lstrip('/')) + '$'
+		else:
+			regex = '^' + prefix + '(?:.*/)?' + globToRegex(line) + '$'
+		rules.append((re.compile(regex), negate, dir_only))
+	return rules
+
+
+class DeployFilter:
+	'''
+	:param read_rules_file: function(repo relative path of a .deployignore) -> its text, or None when there isn't one
+	:param root: repo relative site dir the rules apply to, i.e. 'site_specific/SE'
+	:param default_rules: rules applied from root before any .deployignore
+	'''
+	def __init__(self, read_rules_file, root, default_rules=()):
+		self.read_rules_file = read_rules_file
+		self.root = root.strip('/')
+		self.default_rules = compileRules('\n'.join(default_rules) + '\n' + DEPLOY_IGNORE_FILENAME, self.root)
+		self.dir_rules = {}
+		self.dir_excluded = {}
+		self.filtered_files = 0
+		self.filtered_bytes = 0
+
+	def rulesFor(self, dirpath):
+		rules = self.dir_rules.get(dirpath)
+		if rules is None:
+			if dirpath == self.root:
+				rules = list(self.default_rules)
+			else:
+				rules = list(self.rulesFor(dirpath.rsplit('/', 1)[0]))
+			text = self.read_rules_file(dirpath + '/' + DEPLOY_IGNORE_FILENAME)
+			if text:
+				rules.extend(compileRules(text, dirpath))
+			self.dir_rules[dirpath] = rules
+		return rules
+
+	def matches(self, path, is_dir):
+		parent = path.rsplit('/', 1)[0]
+		excluded = False
+		for regex, negate, dir_only in self.rulesFor(parent):
+			if dir_only and not is_dir:
+				continue
+			if regex.match(path):
+				excluded = not negate
+		return excluded
+
+	def isDirExcluded(self, dirpath):
+		if dirpath == self.root:
+			return False
+		excluded = self.dir_excluded.get(dirpath)
+		if excluded is None:
+			parent = dirpath.rsplit('/', 1)[0]
+			# Like git, nothing under an excluded dir can be included again
+			excluded = self.isDirExcluded(parent) or self.matches(dirpath, True)
+			self.dir_excluded[dirpath] = excluded
+		return excluded
+
+	def isExcluded(self, path):
+		'''
+		:param path: repo relative file path
+		'''
+		if not path.startswith(self.root + '/'):
+			return False
+		return self.isDirExcluded(path.rsplit('/', 1)[0]) or self.matches(path, False)
+
+	def count(self, nbytes):
+		self.filtered_files += 1
+		self.filtered_bytes += nbytes
+
+	def report(self):
+		return 'Filtered out {} files ({} bytes) by deploy rules'.format(self.filtered_files, self.filtered_bytes)
@@ -0,0 +1,206 @@
+# Timing and throughput of the phases of a deploy
+# Phases are timed with `with metrics.phase(name)` or by wrapping one stage of the streaming diff pipeline in
+# metrics.iterPhase(name, iterable). Time is exclusive: a phase running inside another (a pipeline stage pulling from
+# the one before it) is taken out of the outer phase's time, so the phases of one thread add up to its wall time.
+# Work done on other threads is added with record(), i.e. the copies of the PlacementExecutor, whose seconds are
+# summed over its threads rather than wall time.
+# Each phase counts files and bytes next to its seconds. The results of a run (or of every site of a --sites run)
+# are written as JSON and as a Prometheus textfile for node_exporter's textfile collector.
+# profiled(path) runs a block under cProfile and saves the stats for `python -m pstats`.
+
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'deploy'
+
+
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.started = time.time()
+			self.started_monotonic = time.monotonic()
+			self.phases = {}
+			self.ok = None
+
+	def record(self, name, seconds=0.0, files=0, nbytes=0):
+		with self.lock:
+			phase = self.phases.get(name)
+			if phase is None:
+				phase = self.phases[name] = {'seconds': 0.0, 'files': 0, 'bytes': 0}
+			phase['seconds'] += seconds
+			phase['files'] += files
+			phase['bytes'] += nbytes
+
+	def stack(self):
+		stack = getattr(self.local, 'stack', None)
+		if stack is None:
+			stack = self.local.stack = []
+		return stack
+
+	def enter(self):
+		# [start, seconds spent in phases nested in this one]
+		self.stack().append([time.monotonic(), 0.0])
+
+	def leave(self, name, files=0, nbytes=0):
+		stack = self.stack()
+		start, nested = stack.pop()
+		elapsed = time.monotonic() - start
+		if stack:
+			stack[-1][1] += elapsed
+		self.record(name, elapsed - nested, files, nbytes)
+
+	@contextmanager
+	def phase(self, name):
+		self.enter()
+		try:
+			yield
+		finally:
+			self.leave(name)
+
+	def iterPhase(self, name, iterable, count_items=True):
+		'''
+		Passes the items of iterable through, timing the work done to produce each one.
+		:param count_items: count every item as a file of the phase
+		'''
+		it = iter(iterable)
+		while True:
+			self.enter()
+			try:
+				item = next(it)
+			except StopIteration:
+				self.leave(name)
+				return
+			except Exception:
+				self.leave(name)
+				raise
+			self.leave(name, files=1 if count_items else 0)
+			yield item
+
+	def toDict(self):
+		with self.lock:
+			phases = {}
+			for name, phase in self.phases.items():
+				phases[name] = dict(phase)
+				if phase['seconds'] > 0:
+					phases[name]['files_per_second'] = phase['files'] / phase['seconds']
+					phases[name]['bytes_per_second'] = phase['bytes'] / phase['seconds']
+			return {
+				'started': self.started,
+				'seconds': time.monotonic() - self.started_monotonic,
+				'ok': self.ok,
+				'phases': phases,
+			}
+
+	def report(self):
+		run = self.toDict()
+		slowest = sorted(run['phases'].items(), key=lambda p: p[1]['seconds'], reverse=True)
+		return 'Phases ({:.1f}s run): {}'.format(run['seconds'], ', '.join('{} {:.2f}s/{} files/{} bytes'.format(
+			name, phase['seconds'], phase['files'], phase['bytes']) for name, phase in slowest) or '-')
+
+
+def writeAtomic(path, text):
+	# The textfile collector may read at any time, it must never see half a file
+	tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmp_path, 'w') as f:
+		f.write(text)
+	os.replace(tmp_path, path)
+
+
+def writeMetricsJson(path, runs):
+	'''
+	:param runs: dictionary mapping each deploy (branch or site) to its Metrics.toDict()
+	'''
+	writeAtomic(path, json.dumps(runs, indent=1, sort_keys=True))
+
+
+def labelValue(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def writeMetricsTextfile(path, runs, prefix=METRIC_PREFIX):
+	'''
+	Prometheus text exposition format, one series per deploy and phase.
+	:param runs: dictionary mapping each deploy (branch or site) to its Metrics.toDict()
+	'''
+	prefix = re.sub(r'[^a-zA-Z0-9_]', '_', prefix)
+	series = [
+		('run_timestamp_seconds', 'gauge', 'Unix time the deploy started'),
+		('run_seconds', 'gauge', 'Wall time of the deploy'),
+		('run_success', 'gauge', '1 if the deploy placed every file and built every target'),
+		('phase_seconds', 'gauge', 'Seconds spent in the phase, summed over threads for placement phases'),
+		('phase_files', 'gauge', 'Files handled by the phase'),
+		('phase_bytes', 'gauge', 'Bytes handled by the phase'),
+	]
+	lines = []
+	for metric, metric_type, help_text in series:
+		lines.append('# HELP {}_{} {}'.format(prefix, metric, help_text))
+		lines.append('# TYPE {}_{} {}'.format(prefix, metric, metric_type))
+		for deploy, run in sorted(runs.items()):
+			labels = 'deploy="{}"'.format(labelValue(deploy))
+			if metric == 'run_timestamp_seconds':
+				lines.append('{}_{}{{{}}} {}'.format(prefix, metric, labels, run['started']))
+			elif metric == 'run_seconds':
+				lines.append('{}_{}{{{}}} {}'.format(prefix, metric, labels, run['seconds']))
+			elif metric == 'run_success':
+				if run['ok'] is not None:
+					lines.append('{}_{}{{{}}} {}'.format(prefix, metric, labels, int(run['ok'])))
+			else:
+				key = metric[len('phase_'):]
+				for name, phase in sorted(run['phases'].items()):
+					lines.append('{}_{}{{{},phase="{}"}} {}'.format(prefix, metric, labels, labelValue(name), phase[key]))
+	writeAtomic(path, '\n'.join(lines) + '\n')
+
+
+@contextmanager
+def profiled(path, top=25):
+	'''
+	Runs the block under cProfile when path is set and saves the stats to path. Threads started inside the block
+	(the task graph and copy pools) get a profiler of their own, merged into the saved stats, before Python 3.12.
+	From 3.12 on cProfile sits on sys.monitoring, which takes one profiler per process, so only the thread running
+	the block is profiled.
+	:param top: number of functions by cumulative time to log at INFO
+	'''
+	if not path:
+		yield
+		return
+	profiles = [cProfile.Profile()]
+
+	def profileThread(*args):
+		# threading calls this first thing in every new thread, enabling a profiler replaces it for that thread
+		thread_profile = cProfile.Profile()
+		profiles.append(thread_profile)
+		thread_profile.enable()
+
+	# A second enable() raises there ("Another profiling tool is already active") and would kill every pool thread
+	per_thread = sys.version_info < (3, 12)
+	if per_thread:
+		threading.setprofile(profileThread)
+	profiles[0].enable()
+	try:
+		yield
+	finally:
+		profiles[0].disable()
+		if per_thread:
+			threading.setprofile(None)
+		stats = pstats.Stats(profiles[0])
+		for thread_profile in profiles[1:]:
+			stats.add(thread_profile)
+		stats.dump_stats(path)
+		logger.info('profile of {} threads saved to {} (python -m pstats {})'.format(len(profiles), path, path))
+		if logger.isEnabledFor(logging.INFO):
+			stats.sort_stats('cumulative').print_stats(top)
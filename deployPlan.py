@@ -0,0 +1,81 @@
+# Deploy plans: the outcome of a deploy's analysis, saved to a file that can be reviewed and applied later
+# `deployCode.py plan` fetches, diffs, filters and classifies, then writes what the deploy would do:
+#   base / target   commit deployed now and the commit the plan moves to (pinned, not the branch name)
+#   changes         [src, dst] pairs per change type, dst relative to the dst root the plan is applied to
+#   ant_targets     targets to build, dependency order
+#   jar_fanout      jar/war filename -> destinations relative to the jar root, found when the plan was made
+# `deployCode.py apply PLAN` runs exactly that: no fetch, no diff, the merge is of the pinned commit and it refuses
+# to run once the repo moved away from base.
+# Plans are JSON, gzip compressed when the path ends in .gz.
+
+import gzip
+import json
+import os
+import time
+
+PLAN_VERSION = 2 # 2: R only holds exact renames, a rename that changed the file is saved as D and A
+# Order apply runs the change types in. Renames go first so nothing written later lands on a path before it moved away.
+CHANGE_TYPES = ('R', 'D', 'A', 'M')
+
+
+def makePlan(branch_name, base, target, changes, ant_targets, jar_fanout, filtered=None):
+	'''
+	:param changes: dictionary mapping 'A', 'M', 'R', 'D' to lists of [src, dst]
+	:param filtered: (files, bytes) dropped by the deploy filter, for the reviewer
+	'''
+	return {
+		'version': PLAN_VERSION,
+		'created': time.time(),
+		'branch': branch_name,
+		'base': base,
+		'target': target,
+		'changes': {letter: changes.get(letter, []) for letter in CHANGE_TYPES},
+		'ant_targets': list(ant_targets),
+		'jar_fanout': jar_fanout,
+		'filtered': list(filtered) if filtered else [0, 0],
+	}
+
+
+def openPlan(path, mode):
+	if path.endswith('.gz'):
+		return gzip.open(path, mode + 't', encoding='utf-8')
+	return open(path, mode)
+
+
+def writePlan(path, plan):
+	# Same suffix as path so the temp file is compressed the same way
+	tmp_path = '{}.{}.tmp{}'.format(path, os.getpid(), '.gz' if path.endswith('.gz') else '')
+	with openPlan(tmp_path, 'w') as f:
+		json.dump(plan, f, separators=(',', ':'))
+	os.replace(tmp_path, path)
+
+
+def readPlan(path):
+	with openPlan(path, 'r') as f:
+		plan = json.load(f)
+	if plan.get('version') != PLAN_VERSION:
+		raise ValueError('plan {} has version {}, expected {}'.format(path, plan.get('version'), PLAN_VERSION))
+	return plan
+
+
+def iterPlanPairs(plan, dst_root):
+	'''
+	:param dst_root: root the plan's destinations are placed under (the live dir, or a staged release)
+	:return: generator of (change type, src, dst) like deployCode.iter_deploy_pairs
+	'''
+	for letter in CHANGE_TYPES:
+		for src, dst in plan['changes'][letter]:
+			if letter == 'R':
+				# An exact rename (R100) moves the file already deployed at the old destination, renames that changed
+				# the file were planned as D of the old destination and A from the repo
+				yield letter, dst_root + src, dst_root + dst
+			else:
+				yield letter, src, dst_root + dst
+
+
+def planSummary(plan):
+	counts = ', '.join('{}: {}'.format(letter, len(plan['changes'][letter])) for letter in CHANGE_TYPES)
+	jar_dsts = sum(len(dsts) for dsts in plan['jar_fanout'].values())
+	return 'Plan {}..{} on {}: {} | ant: {} | {} jar destinations | filtered {} files ({} bytes)'.format(
+		plan['base'][:12], plan['target'][:12], plan['branch'], counts, ', '.join(plan['ant_targets']) or '-', jar_dsts,
+		plan['filtered'][0], plan['filtered'][1])
@@ -0,0 +1,148 @@
+# Running deploys from a long lived process instead of a cold start per deploy (deployCode.py watch)
+# The caller keeps its warm state (Repo, path classifier, jar manifest, hash cache) and hands in three functions:
+#   poll()            fetch and return the remote commit SHA
+#   is_deployed(sha)  whether sha is already live
+#   deploy(sha)       deploy it, True on success
+# and optionally
+#   is_held(sha)      whether sha must not be deployed on its own (i.e. it was rolled back), watch waits for a newer one
+# A new commit is only deployed once the remote stayed on it for `debounce` seconds, so a burst of pushes turns into
+# one deploy of the last one. Failed polls and deploys back off exponentially up to max_backoff.
+# The status is served as JSON on a local HTTP port: GET /status always, GET /health answers 503 while the last
+# poll or deploy failed.
+
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+	def __init__(self, poll, is_deployed, deploy, interval, debounce=0, max_backoff=None, is_held=None):
+		self.poll = poll
+		self.is_deployed = is_deployed
+		self.deploy = deploy
+		self.is_held = is_held
+		self.interval = interval
+		self.debounce = debounce
+		self.max_backoff = max_backoff or interval
+		self.stop_event = threading.Event()
+		self.lock = threading.Lock()
+		self.status = {
+			'state': 'starting',
+			'started': time.time(),
+			'remote': None,
+			'pending': None,
+			'deployed': None,
+			'last_poll': None,
+			'last_error': None,
+			'failures': 0,
+			'deploys': 0,
+			'last_deploy': None,
+		}
+
+	def update(self, **values):
+		with self.lock:
+			self.status.update(values)
+
+	def snapshot(self):
+		with self.lock:
+			status = dict(self.status)
+		status['uptime'] = time.time() - status['started']
+		return status
+
+	def stop(self):
+		self.stop_event.set()
+
+	def runDeploy(self, sha):
+		self.update(state='deploying')
+		started = time.time()
+		logger.info('deploying {}'.format(sha))
+		ok = bool(self.deploy(sha))
+		finished = time.time()
+		with self.lock:
+			self.status['deploys'] += 1
+			self.status['last_deploy'] = {'sha': sha, 'ok': ok, 'started': started, 'seconds': finished - started}
+			if ok:
+				self.status['deployed'] = sha
+				self.status['pending'] = None
+		logger.info('deploy of {} {} in {:.1f}s'.format(sha, 'finished' if ok else 'FAILED', finished - started))
+		return ok
+
+	def step(self):
+		'''
+		One poll, and a deploy if one is due.
+		:return: seconds to wait before the next step
+		'''
+		now = time.time()
+		sha = self.poll()
+		self.update(remote=sha, last_poll=now)
+		if sha == self.status['deployed'] or self.is_deployed(sha):
+			self.update(state='idle', pending=None, deployed=sha)
+			return self.interval
+		if self.is_held is not None and self.is_held(sha):
+			self.update(state='held', pending=None)
+			return self.interval
+
+		pending = self.status['pending']
+		if pending is None or pending[0] != sha:
+			# New push, (re)start the quiet period
+			pending = (sha, now)
+			self.update(pending=pending)
+		wait = pending[1] + self.debounce - now
+		if wait > 0:
+			self.update(state='debouncing')
+			return min(self.interval, wait)
+		if not self.runDeploy(sha):
+			raise RuntimeError('deploy of {} failed'.format(sha))
+		self.update(state='idle')
+		return self.interval
+
+	def run(self):
+		while not self.stop_event.is_set():
+			try:
+				delay = self.step()
+				self.update(failures=0, last_error=None)
+			except Exception as e:
+				with self.lock:
+					self.status['failures'] += 1
+					failures = self.status['failures']
+					self.status['last_error'] = str(e)
+					self.status['state'] = 'backoff'
+				delay = min(self.interval * 2 ** (failures - 1), self.max_backoff)
+				logger.error('{} (retrying in {}s)'.format(e, delay))
+			self.stop_event.wait(delay)
+		self.update(state='stopped')
+
+
+def startHealthServer(watcher, address):
+	'''
+	Serves watcher's status on address, i.e. ('127.0.0.1', 8787), from a daemon thread.
+	:return: the server, shutdown() stops it
+	'''
+	class StatusHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			status = watcher.snapshot()
+			if self.path == '/health':
+				code = 200 if status['failures'] == 0 else 503
+			elif self.path == '/status':
+				code = 200
+			else:
+				self.send_error(404)
+				return
+			body = json.dumps(status).encode()
+			self.send_response(code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			logger.debug(format % args)
+
+	server = ThreadingHTTPServer(address, StatusHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
@@ -0,0 +1,196 @@
+# Locating the .jar/.war files on the app VM
+# Shared by deployCode.py and updateJars.py so both scripts only walk the app root once per run.
+# The walk uses os.scandir so the basename is checked against the requested jar names before anything
+# else, and directory type comes from the dirent (no extra stat per file on Linux).
+#
+# The result of a walk can be saved as a manifest (JSON) that records, for every directory under the root,
+# its mtime, the requested jars it contains and its subdirectories. Adding, removing or renaming an entry
+# changes the mtime of the directory holding it, so a later run only has to stat each known directory and
+# re-scan the ones whose mtime moved instead of listing the whole tree again.
+# A long running process (deployCode.py watch) also keeps the last manifest in memory and only reads the file
+# again when it was changed by someone else.
+# Dir records are relative to the root, so a manifest also carries over to a copy of the tree next to the one it was
+# made for (moved_root, i.e. each staged release is linked from the live one and keeps its dir mtimes).
+
+import json
+import os
+
+JAR_MANIFEST_VERSION = 1
+
+# manifest path -> (mtime_ns of the file, manifest)
+_loaded_manifests = {}
+
+
+def _scanDir(dirpath, abs_dirpath, wanted, skip_abspaths):
+    # Returns [mtime_ns, jars found directly in dirpath, subdir names to descend into]
+    # mtime is read before listing so a change made while listing shows up as stale on the next run
+    mtime = os.stat(dirpath).st_mtime_ns
+    jars = []
+    subdirs = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if os.path.join(abs_dirpath, entry.name) not in skip_abspaths:
+                    subdirs.append(entry.name)
+            elif entry.name in wanted:
+                jars.append(entry.name)
+    return [mtime, jars, subdirs]
+
+
+def _walkDirs(rootdir, wanted, skip_abspaths, known_dirs=None):
+    '''
+    :param known_dirs: dir records from a previous walk, keyed by path relative to rootdir ('' is rootdir itself).
+        A record is reused when the directory's mtime still matches, otherwise that directory is listed again.
+    :return: (dir records for the whole tree, number of directories that had to be listed)
+    '''
+    if known_dirs is None:
+        known_dirs = {}
+    abs_rootdir = os.path.abspath(rootdir)
+    dirs = {}
+    rescanned = 0
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        dirpath = os.path.join(rootdir, rel) if rel else rootdir
+        record = known_dirs.get(rel)
+        try:
+            if record is None or os.stat(dirpath).st_mtime_ns != record[0]:
+                abs_dirpath = os.path.join(abs_rootdir, rel) if rel else abs_rootdir
+                record = _scanDir(dirpath, abs_dirpath, wanted, skip_abspaths)
+                rescanned += 1
+        except OSError:
+            # Same as os.walk: unreadable (or since removed) directories are skipped
+            continue
+        dirs[rel] = record
+        # Reversed so subdirectories are visited in the order scandir returned them
+        for name in reversed(record[2]):
+            stack.append(os.path.join(rel, name) if rel else name)
+    return dirs, rescanned
+
+
+def _locationsFromDirs(filenames, rootdir, dirs):
+    locations = {}
+    for fname in filenames:
+        locations[fname] = []
+    for rel, record in dirs.items():
+        for name in record[1]:
+            if name in locations:
+                locations[name].append(os.path.join(rootdir, rel, name) if rel else os.path.join(rootdir, name))
+    return locations
+
+
+def scanJarLocations(filenames, rootdir='.', skipdirs=()):
+    '''
+    :param filenames: a list of jar filename strings. i.e. ['aotxweb.jar', 'xyz.war, 'cic.jar']
+    :param rootdir: a string of the directory path to recursively search through
+    :param skipdirs: directory paths (i.e. the local git repo) that are pruned during the walk instead of filtered afterward
+    :return: a dictionary mapping the basefilename to a list of all the filepaths discovered in the rootdir.
+    '''
+    skip_abspaths = set(os.path.abspath(d) for d in skipdirs)
+    dirs, _ = _walkDirs(rootdir, set(filenames), skip_abspaths)
+    return _locationsFromDirs(filenames, rootdir, dirs)
+
+
+def readJarManifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != JAR_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def writeJarManifest(manifest_path, manifest):
+    # Written next to the old one and swapped in so an interrupted run never leaves a half written manifest
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, manifest_path)
+    _loaded_manifests[manifest_path] = (os.stat(manifest_path).st_mtime_ns, manifest)
+
+
+def cachedJarManifest(manifest_path):
+    # readJarManifest, skipping the read and parse when the file is the one this process loaded or wrote last
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        return None
+    loaded = _loaded_manifests.get(manifest_path)
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+    manifest = readJarManifest(manifest_path)
+    if manifest is not None:
+        _loaded_manifests[manifest_path] = (mtime, manifest)
+    return manifest
+
+
+def loadJarLocations(filenames, rootdir='.', skipdirs=(), manifest_path=None, rescan=False, verbose=False, moved_root=False):
+    '''
+    Same result as scanJarLocations, but backed by the manifest saved at manifest_path.
+    Only directories whose mtime changed since the manifest was written are listed again.
+    :param rescan: ignore the saved manifest and walk the whole rootdir
+    :param moved_root: rootdir is a copy of the tree the manifest was made for, in the same parent dir (the releases
+        dir of a staged deploy). The saved dirs are rebased onto rootdir instead of being thrown away.
+    :return: a dictionary mapping the basefilename to a list of all the filepaths discovered in the rootdir.
+    '''
+    if manifest_path is None:
+        return scanJarLocations(filenames, rootdir=rootdir, skipdirs=skipdirs)
+
+    abs_rootdir = os.path.abspath(rootdir)
+    skip_abspaths = sorted(set(os.path.abspath(d) for d in skipdirs))
+    tracked = set(filenames)
+    known_dirs = None
+
+    manifest = None if rescan else cachedJarManifest(manifest_path)
+    # A manifest made for another root, other skipped dirs, or fewer jar names can't be refreshed incrementally
+    same_root = manifest is not None and (manifest['rootdir'] == abs_rootdir or
+                                          (moved_root and os.path.dirname(manifest['rootdir']) == os.path.dirname(abs_rootdir)))
+    if same_root and manifest['skipdirs'] == skip_abspaths and tracked.issubset(manifest['filenames']):
+        tracked = set(manifest['filenames'])
+        known_dirs = manifest['dirs']
+
+    dirs, rescanned = _walkDirs(rootdir, tracked, set(skip_abspaths), known_dirs=known_dirs)
+    if verbose:
+        if known_dirs is None:
+            print('Full scan of {}: {} dirs'.format(rootdir, len(dirs)))
+        else:
+            print('Refreshed jar manifest {}: re-scanned {} of {} dirs'.format(manifest_path, rescanned, len(dirs)))
+
+    if known_dirs is None or rescanned or len(dirs) != len(known_dirs) or manifest['rootdir'] != abs_rootdir:
+        writeJarManifest(manifest_path, {
+            'version': JAR_MANIFEST_VERSION,
+            'rootdir': abs_rootdir,
+            'skipdirs': skip_abspaths,
+            'filenames': sorted(tracked),
+            'dirs': dirs,
+        })
+
+    return _locationsFromDirs(filenames, rootdir, dirs)
+
+
+def verifyJarManifest(manifest_path, rootdir='.'):
+    '''
+    Compares the saved manifest against a full walk of rootdir, without updating the manifest.
+    :return: a dictionary with 'missing' (listed in the manifest but not on disk) and 'unlisted' (on disk but not in
+        the manifest) jar paths, or None when there is no usable manifest at manifest_path.
+    '''
+    manifest = readJarManifest(manifest_path)
+    if manifest is None:
+        return None
+    filenames = manifest['filenames']
+    saved = _locationsFromDirs(filenames, rootdir, manifest['dirs'])
+    on_disk = scanJarLocations(filenames, rootdir=rootdir, skipdirs=manifest['skipdirs'])
+
+    report = {'missing': [], 'unlisted': []}
+    for fname in filenames:
+        saved_paths = set(saved[fname])
+        disk_paths = set(on_disk[fname])
+        report['missing'].extend(sorted(saved_paths - disk_paths))
+        report['unlisted'].extend(sorted(disk_paths - saved_paths))
+    return report
@@ -0,0 +1,64 @@
+# Routing repo paths from the git diff
+# Built once per run from the branch name and the jar source dir names. Every repo relative path is sorted in one
+# walk over its leading components (a trie, so the cost doesn't grow with the number of jar targets):
+#   site_specific/<branch>/<rest>   -> SITE_FILE, deployed to dst_root + <rest>
+#   site_agnostic/<target>/...      -> JAR_SOURCE, ant target <target>
+#   site_specific/<target>/...      -> JAR_SOURCE, ant target <target>
+#   anything else                   -> IGNORED
+
+import copy
+
+SITE_FILE = 'site'
+JAR_SOURCE = 'jar_source'
+IGNORED = 'ignored'
+JAR_SRC_PARENT_DIRNAMES = ('site_agnostic', 'site_specific')
+
+# Key holding a node's result. Path components are never None, so it can't clash with a child dir name.
+LEAF = None
+
+
+class PathClassifier:
+	def __init__(self, branch_name, jar_src_dirnames, dst_root='', jar_src_parents=JAR_SRC_PARENT_DIRNAMES):
+		self.branch_name = branch_name
+		self.dst_root = dst_root
+		self.trie = {}
+		for parent in jar_src_parents:
+			for target in jar_src_dirnames:
+				self.add([parent, target], (JAR_SOURCE, target))
+		# Added last so the site dir wins if a branch is ever named like a jar dir
+		self.add(['site_specific', branch_name], (SITE_FILE, None))
+
+	def withDstRoot(self, dst_root):
+		'''
+		:return: classifier sharing this one's trie, with its destinations under dst_root
+		'''
+		clone = copy.copy(self)
+		clone.dst_root = dst_root
+		return clone
+
+	def add(self, components, result):
+		node = self.trie
+		for component in components:
+			node = node.setdefault(component, {})
+		node[LEAF] = result
+
+	def classify(self, path):
+		'''
+		:param path: path relative to the git repo root, i.e. a_path / b_path from the diff
+		:return: (SITE_FILE, destination path), (JAR_SOURCE, ant target) or (IGNORED, None)
+		'''
+		node = self.trie
+		start = 0
+		while True:
+			slash = path.find('/', start)
+			if slash == -1:
+				return IGNORED, None
+			node = node.get(path[start:slash])
+			if node is None:
+				return IGNORED, None
+			start = slash + 1
+			result = node.get(LEAF)
+			if result is not None:
+				if result[0] == SITE_FILE:
+					return SITE_FILE, self.dst_root + path[start:]
+				return result
@@ -0,0 +1,321 @@
+# Local store of every deployed release, so a bad deploy can be rolled back without git or the network
+# Each deploy records a manifest of the files under its dst root: path relative to the root -> sha256 of the content
+# and the mode. Contents go into objects/<first 2 hex>/<rest of the hex>, one file per distinct content, so releases
+# share everything they have in common. Hashes come from copyEngine.HashCache, so a file that didn't change since the
+# last record is only stat'ed.
+# In place deploys walk the tree once, for the first release. After that recordChanges() builds each manifest from the
+# live one plus the paths the deploy placed, moved or removed, and only those files are stat'ed and stored.
+# Rolling back compares the manifest of the live release with the one rolled back to and only writes the paths that
+# differ, each one through a temp file and a rename.
+# gc() keeps the newest `retention` releases of every name (and whichever one is live) and removes the objects none of
+# the kept manifests use.
+# With link_objects, objects are hardlinks to the deployed files instead of copies. Only safe when deployed files are
+# never written in place (staged deploys, see stagedRelease.py).
+# A rollback also notes the commit it rolled away from (ROLLED_BACK), so `deployCode.py watch` doesn't deploy it again.
+
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+from copyEngine import HashCache
+
+RELEASE_MANIFEST_VERSION = 1
+CURRENT_FILENAME = 'CURRENT'
+ROLLED_BACK_FILENAME = 'ROLLED_BACK'
+
+
+def writeJson(path, data):
+	tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmp_path, 'w') as f:
+		json.dump(data, f, separators=(',', ':'))
+	os.replace(tmp_path, path)
+
+
+class ReleaseStore:
+	'''
+	:param store_dir: dir holding the objects and manifests, shared by every name
+	:param name: which deploy the manifests belong to, i.e. the branch or site
+	:param hash_cache: copyEngine.HashCache to reuse (the deploy's FileCopier one), a new in memory one when None
+	:param link_objects: hardlink objects to the deployed files instead of copying them
+	'''
+	def __init__(self, store_dir, name, hash_cache=None, link_objects=False):
+		self.store_dir = store_dir
+		self.name = name
+		self.objects_dir = os.path.join(store_dir, 'objects')
+		self.manifests_root = os.path.join(store_dir, 'releases')
+		self.manifests_dir = os.path.join(self.manifests_root, name)
+		self.hash_cache = hash_cache if hash_cache is not None else HashCache()
+		self.link_objects = link_objects
+		self.stored_objects = 0
+		self.stored_bytes = 0
+		self.removed_objects = 0
+		os.makedirs(self.objects_dir, exist_ok=True)
+		os.makedirs(self.manifests_dir, exist_ok=True)
+
+	def objectPath(self, sha):
+		return os.path.join(self.objects_dir, sha[:2], sha[2:])
+
+	def manifestPath(self, release_id):
+		return os.path.join(self.manifests_dir, release_id + '.json')
+
+	def walk(self, root, paths=None):
+		'''
+		:param paths: top level entries of root to record, everything under root when None
+		:return: generator of (path relative to root, os.DirEntry) for every file and symlink
+		'''
+		stack = []
+		with os.scandir(root) as it:
+			for entry in it:
+				if paths is not None and entry.name not in paths:
+					continue
+				if entry.is_dir(follow_symlinks=False):
+					stack.append(entry.name)
+				else:
+					yield entry.name, entry
+		while stack:
+			rel = stack.pop()
+			with os.scandir(os.path.join(root, rel)) as it:
+				for entry in it:
+					if entry.is_dir(follow_symlinks=False):
+						stack.append(rel + '/' + entry.name)
+					else:
+						yield rel + '/' + entry.name, entry
+
+	def ingest(self, path, sha):
+		obj = self.objectPath(sha)
+		if os.path.exists(obj):
+			return
+		os.makedirs(os.path.dirname(obj), exist_ok=True)
+		tmp_path = '{}.{}.{}.tmp'.format(obj, os.getpid(), threading.get_ident())
+		if self.link_objects:
+			try:
+				os.link(path, tmp_path)
+			except OSError:
+				shutil.copy2(path, tmp_path)
+		else:
+			shutil.copy2(path, tmp_path)
+		os.replace(tmp_path, obj)
+		self.stored_objects += 1
+		self.stored_bytes += os.path.getsize(obj)
+
+	def record(self, release_id, root, commit, paths=None):
+		'''
+		Stores every file under root that isn't in the store yet and saves the release manifest. Marks it as live.
+		:param commit: git commit the release was deployed from
+		:return: the manifest
+		'''
+		files = {}
+		symlinks = {}
+		for rel, entry in self.walk(root, paths):
+			if entry.is_symlink():
+				symlinks[rel] = os.readlink(entry.path)
+				continue
+			st = entry.stat(follow_symlinks=False)
+			# Linked releases are linked again on every staged deploy, which changes ctime but never the content
+			sha = self.hash_cache.digest(entry.path, st, linked=self.link_objects)
+			self.ingest(entry.path, sha)
+			files[rel] = [sha, stat.S_IMODE(st.st_mode)]
+		return self.saveManifest(release_id, commit, files, symlinks)
+
+	def recordChanges(self, release_id, root, commit, changed, paths=None):
+		'''
+		record() for an in place deploy: the live manifest with the changed paths updated, nothing else under root is
+		looked at. Falls back to record() when nothing is live yet.
+		:param changed: paths the deploy wrote, moved or removed, the ones outside root (or outside paths) are ignored
+		:param paths: top level entries of root that are recorded
+		:return: the manifest
+		'''
+		current_id = self.current()
+		if current_id is None:
+			return self.record(release_id, root, commit, paths)
+		live = self.load(current_id)
+		files = dict(live['files'])
+		symlinks = dict(live['symlinks'])
+		abs_root = os.path.abspath(root)
+		for path in changed:
+			rel = os.path.relpath(os.path.abspath(path), abs_root).replace(os.sep, '/')
+			if rel.startswith('../') or rel in ('.', '..'):
+				continue
+			if paths is not None and rel.split('/', 1)[0] not in paths:
+				continue
+			files.pop(rel, None)
+			symlinks.pop(rel, None)
+			full_path = os.path.join(abs_root, rel)
+			try:
+				st = os.lstat(full_path)
+			except FileNotFoundError:
+				continue
+			if stat.S_ISLNK(st.st_mode):
+				symlinks[rel] = os.readlink(full_path)
+			elif stat.S_ISREG(st.st_mode):
+				sha = self.hash_cache.digest(full_path, st, linked=self.link_objects)
+				self.ingest(full_path, sha)
+				files[rel] = [sha, stat.S_IMODE(st.st_mode)]
+		return self.saveManifest(release_id, commit, files, symlinks)
+
+	def saveManifest(self, release_id, commit, files, symlinks):
+		manifest = {
+			'version': RELEASE_MANIFEST_VERSION,
+			'name': self.name,
+			'release_id': release_id,
+			'commit': commit,
+			'created': time.time(),
+			'files': files,
+			'symlinks': symlinks,
+		}
+		writeJson(self.manifestPath(release_id), manifest)
+		self.setCurrent(release_id)
+		return manifest
+
+	def load(self, release_id):
+		with open(self.manifestPath(release_id)) as f:
+			manifest = json.load(f)
+		if manifest.get('version') != RELEASE_MANIFEST_VERSION:
+			raise ValueError('release manifest {} has version {}'.format(release_id, manifest.get('version')))
+		return manifest
+
+	def releases(self):
+		'''
+		:return: list of (release_id, created, commit), newest first
+		'''
+		found = []
+		for fname in os.listdir(self.manifests_dir):
+			if not fname.endswith('.json'):
+				continue
+			try:
+				manifest = self.load(fname[:-len('.json')])
+			except (OSError, ValueError):
+				continue
+			found.append((manifest['release_id'], manifest['created'], manifest['commit']))
+		found.sort(key=lambda r: r[1], reverse=True)
+		return found
+
+	def current(self):
+		try:
+			with open(os.path.join(self.manifests_dir, CURRENT_FILENAME)) as f:
+				return f.read().strip() or None
+		except OSError:
+			return None
+
+	def setCurrent(self, release_id):
+		path = os.path.join(self.manifests_dir, CURRENT_FILENAME)
+		tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+		with open(tmp_path, 'w') as f:
+			f.write(release_id + '\n')
+		os.replace(tmp_path, path)
+
+	def rolledBack(self):
+		'''
+		:return: commit the last rollback moved away from, None when there was none since clearRolledBack()
+		'''
+		try:
+			with open(os.path.join(self.manifests_dir, ROLLED_BACK_FILENAME)) as f:
+				return f.read().strip() or None
+		except OSError:
+			return None
+
+	def setRolledBack(self, commit):
+		path = os.path.join(self.manifests_dir, ROLLED_BACK_FILENAME)
+		tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+		with open(tmp_path, 'w') as f:
+			f.write(commit + '\n')
+		os.replace(tmp_path, path)
+
+	def clearRolledBack(self):
+		try:
+			os.remove(os.path.join(self.manifests_dir, ROLLED_BACK_FILENAME))
+		except FileNotFoundError:
+			pass
+
+	def previous(self):
+		'''
+		:return: id of the release recorded before the live one, or None
+		'''
+		current = self.current()
+		ids = [r[0] for r in self.releases()]
+		if current in ids:
+			ids = ids[ids.index(current) + 1:]
+		return ids[0] if ids else None
+
+	def placeObject(self, sha, mode, dst):
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+		tmp_path = '{}.{}.rb'.format(dst, os.getpid())
+		if self.link_objects:
+			os.link(self.objectPath(sha), tmp_path)
+		else:
+			shutil.copy2(self.objectPath(sha), tmp_path)
+			os.chmod(tmp_path, mode)
+		os.replace(tmp_path, dst)
+
+	def restore(self, release_id, root):
+		'''
+		Turns the live release under root into release_id, writing only the paths that differ between the two manifests.
+		:return: dictionary with the number of files 'restored' and 'removed'
+		'''
+		target = self.load(release_id)
+		current_id = self.current()
+		if current_id is not None:
+			live = self.load(current_id)
+		else:
+			live = {'files': {}, 'symlinks': {}}
+
+		removed = 0
+		for rel in set(live['files']).union(live['symlinks']):
+			if rel not in target['files'] and rel not in target['symlinks']:
+				try:
+					os.remove(os.path.join(root, rel))
+				except FileNotFoundError:
+					pass
+				removed += 1
+
+		restored = 0
+		for rel, (sha, mode) in target['files'].items():
+			if live['files'].get(rel) != [sha, mode]:
+				self.placeObject(sha, mode, os.path.join(root, rel))
+				restored += 1
+		for rel, link_target in target['symlinks'].items():
+			if live['symlinks'].get(rel) != link_target:
+				dst = os.path.join(root, rel)
+				os.makedirs(os.path.dirname(dst), exist_ok=True)
+				tmp_path = '{}.{}.rb'.format(dst, os.getpid())
+				os.symlink(link_target, tmp_path)
+				os.replace(tmp_path, dst)
+				restored += 1
+
+		self.setCurrent(release_id)
+		return {'restored': restored, 'removed': removed}
+
+	def gc(self, retention):
+		'''
+		:param retention: number of releases to keep per name, besides the live one
+		:return: dictionary mapping each name to the release ids dropped from it
+		'''
+		dropped = {}
+		used = set()
+		for name in os.listdir(self.manifests_root):
+			store = self if name == self.name else ReleaseStore(self.store_dir, name)
+			current = store.current()
+			dropped[name] = []
+			kept = 0
+			for release_id, created, commit in store.releases():
+				if release_id == current or kept < retention:
+					if release_id != current:
+						kept += 1
+					for sha, mode in store.load(release_id)['files'].values():
+						used.add(sha)
+				else:
+					os.remove(store.manifestPath(release_id))
+					dropped[name].append(release_id)
+
+		for prefix in os.listdir(self.objects_dir):
+			prefix_dir = os.path.join(self.objects_dir, prefix)
+			for rest in os.listdir(prefix_dir):
+				if prefix + rest not in used:
+					os.remove(os.path.join(prefix_dir, rest))
+					self.removed_objects += 1
+		return dropped
+
+	def report(self):
+		return 'Release store: {} new objects ({} bytes) stored'.format(self.stored_objects, self.stored_bytes)
@@ -0,0 +1,123 @@
+# Staged deploys: the live app dir is a symlink to a release dir, a new release is built next to it and swapped in
+# The new release starts as a hardlink copy of the live one (one link per file, no data copied), the changes of the
+# deploy are applied to it, then the live symlink is replaced with os.replace, which is a single atomic rename.
+# The app sees either the old release or the new one, never a mix.
+# Files written into the release must go to a new inode (FileCopier(replace_links=True)), writing into a hardlinked
+# file in place would change the live release too.
+# The first staged deploy of a live dir that is still a plain directory moves that dir into the releases dir,
+# so there the swap is two renames instead of one.
+
+import logging
+import os
+import shutil
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def linkTree(src, dst):
+	'''
+	Recreates the dir tree of src at dst, hardlinking files and copying symlinks as symlinks.
+	:return: (number of dirs made, number of files linked)
+	'''
+	made_dirs = 0
+	linked_files = 0
+	stack = [(src, dst)]
+	made = []
+	while stack:
+		src_dir, dst_dir = stack.pop()
+		os.mkdir(dst_dir)
+		made.append((src_dir, dst_dir))
+		made_dirs += 1
+		with os.scandir(src_dir) as it:
+			for entry in it:
+				dst_path = os.path.join(dst_dir, entry.name)
+				if entry.is_symlink():
+					os.symlink(os.readlink(entry.path), dst_path)
+				elif entry.is_dir():
+					stack.append((entry.path, dst_path))
+				else:
+					os.link(entry.path, dst_path)
+					linked_files += 1
+	# Modes and mtimes last, after every dir is filled
+	for src_dir, dst_dir in made:
+		shutil.copystat(src_dir, dst_dir)
+	return made_dirs, linked_files
+
+
+def fsyncDir(path):
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+class StagedRelease:
+	'''
+	:param live_path: path the app reads from, a symlink to the current release once staged deploys are in use
+	:param releases_dir: where the release dirs are kept, has to be on the same filesystem as the live release
+	:param release_id: name of the release dir to build, i.e. the deployed commit and a timestamp
+	'''
+	def __init__(self, live_path, releases_dir, release_id):
+		self.live_path = os.path.abspath(live_path.rstrip('/') or '/')
+		if self.live_path in (os.path.abspath(os.curdir), os.path.abspath(os.sep)):
+			raise ValueError('staged deploys need a dedicated live dir to swap, not {}'.format(live_path))
+		self.releases_dir = os.path.abspath(releases_dir)
+		self.release_id = release_id
+		self.path = os.path.join(self.releases_dir, release_id)
+		self.linked_files = 0
+		self.made_dirs = 0
+
+	@property
+	def root(self):
+		# dst_root for the deploy, site file destinations are dst_root + the path under the site dir
+		return self.path + '/'
+
+	def current(self):
+		'''
+		:return: the dir the app currently reads from, or None when nothing is deployed yet
+		'''
+		if os.path.islink(self.live_path):
+			return os.path.realpath(self.live_path)
+		if os.path.isdir(self.live_path):
+			return self.live_path
+		return None
+
+	def prepare(self):
+		os.makedirs(self.releases_dir, exist_ok=True)
+		if os.path.lexists(self.path):
+			# Left behind by a run that failed before its cutover
+			shutil.rmtree(self.path)
+		current = self.current()
+		if current is None:
+			os.mkdir(self.path)
+		else:
+			self.made_dirs, self.linked_files = linkTree(current, self.path)
+		logger.info('staged release {}: linked {} files in {} dirs from {}'.format(self.path, self.linked_files, self.made_dirs, current))
+		return self.path
+
+	def cutover(self):
+		'''
+		Points live_path at the new release.
+		:return: the release the app was reading from before, or None
+		'''
+		previous = self.current()
+		tmp_link = '{}.{}.tmp'.format(self.live_path, os.getpid())
+		os.symlink(self.path, tmp_link)
+		if previous == self.live_path:
+			# Still a plain dir from before staged deploys, keep it as a release of its own
+			kept = os.path.join(self.releases_dir, 'pre_staged_{}'.format(datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+			logger.warning('moving plain live dir {} to {}'.format(self.live_path, kept))
+			os.rename(self.live_path, kept)
+			previous = kept
+		os.replace(tmp_link, self.live_path)
+		fsyncDir(os.path.dirname(self.live_path))
+		logger.info('live: {} -> {}'.format(self.live_path, self.path))
+		return previous
+
+	def abort(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def report(self):
+		return 'Staged release {}: {} files hardlinked from the live release'.format(self.release_id, self.linked_files)
@@ -0,0 +1,123 @@
+# Running the steps of a deploy as a dependency graph on a thread pool
+# A task starts as soon as every task it depends on finished, so independent steps (copying site files, ant builds,
+# the jar fan-out of each build) overlap instead of running one after the other. A task that raises fails, and
+# everything depending on it is skipped. Tasks can add more tasks while the graph runs (i.e. one build task per ant
+# group once the targets are known); a dependency that is never added counts as skipped.
+# After a run, criticalPath() follows the chain of dependencies that decided when the last task finished.
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+WAITING = 'waiting'
+RUNNING = 'running'
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class TaskGraph:
+	def __init__(self, max_workers):
+		self.pool = ThreadPoolExecutor(max_workers=max_workers)
+		self.lock = threading.Lock()
+		self.changed = threading.Condition(self.lock)
+		self.tasks = {}
+		self.order = []
+		self.started = time.monotonic()
+
+	def add(self, name, fn, deps=()):
+		'''
+		:param fn: called without arguments, results of other tasks are read with result()
+		:param deps: names of the tasks that have to finish (successfully) first
+		'''
+		with self.lock:
+			if name in self.tasks:
+				raise ValueError('task {} added twice'.format(name))
+			self.tasks[name] = {'fn': fn, 'deps': list(deps), 'state': WAITING, 'result': None, 'error': None,
+				'start': None, 'end': None}
+			self.order.append(name)
+			self.schedule()
+
+	def schedule(self, finished=False):
+		# Lock held. finished: nothing runs anymore, so dependencies still missing will never be added
+		changed = True
+		while changed:
+			changed = False
+			for name in self.order:
+				task = self.tasks[name]
+				if task['state'] != WAITING:
+					continue
+				states = [self.tasks[dep]['state'] if dep in self.tasks else None for dep in task['deps']]
+				if any(state in (FAILED, SKIPPED) for state in states) or (finished and None in states):
+					task['state'] = SKIPPED
+					changed = True
+				elif all(state == OK for state in states):
+					task['state'] = RUNNING
+					self.pool.submit(self.runTask, name)
+
+	def runTask(self, name):
+		task = self.tasks[name]
+		task['start'] = time.monotonic()
+		try:
+			result = task['fn']()
+			error = None
+		except Exception as e:
+			result = None
+			error = e
+			logger.error('{} failed: {}'.format(name, e))
+		with self.lock:
+			task['end'] = time.monotonic()
+			task['result'] = result
+			task['error'] = error
+			task['state'] = FAILED if error is not None else OK
+			self.schedule()
+			self.changed.notify_all()
+
+	def run(self):
+		'''
+		Blocks until every task ran or was skipped.
+		:return: dictionary mapping each task name to its state
+		'''
+		with self.lock:
+			while True:
+				if any(task['state'] == RUNNING for task in self.tasks.values()):
+					self.changed.wait()
+					continue
+				self.schedule(finished=not any(task['state'] == RUNNING for task in self.tasks.values()))
+				if not any(task['state'] in (RUNNING, WAITING) for task in self.tasks.values()):
+					break
+		self.pool.shutdown()
+		return {name: self.tasks[name]['state'] for name in self.order}
+
+	def result(self, name):
+		return self.tasks[name]['result']
+
+	def state(self, name):
+		task = self.tasks.get(name)
+		return task['state'] if task is not None else None
+
+	def criticalPath(self):
+		'''
+		:return: list of (task name, seconds) from the first task of the chain to the one that finished last
+		'''
+		ran = [name for name in self.order if self.tasks[name]['end'] is not None]
+		if not ran:
+			return []
+		name = max(ran, key=lambda n: self.tasks[n]['end'])
+		path = []
+		while name is not None:
+			task = self.tasks[name]
+			path.append((name, task['end'] - task['start']))
+			deps = [dep for dep in task['deps'] if dep in self.tasks and self.tasks[dep]['end'] is not None]
+			name = max(deps, key=lambda n: self.tasks[n]['end']) if deps else None
+		path.reverse()
+		return path
+
+	def report(self):
+		path = self.criticalPath()
+		wall = max([t['end'] for t in self.tasks.values() if t['end'] is not None] or [self.started]) - self.started
+		steps = ' -> '.join('{} {:.1f}s'.format(name, seconds) for name, seconds in path)
+		return 'Critical path ({:.1f}s of {:.1f}s wall): {}'.format(sum(s for _, s in path), wall, steps or '-')
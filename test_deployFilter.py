@@ -0,0 +1,71 @@
+# Rule forms from the deployFilter.py header, run with `python -m pytest` or `python -m unittest`
+
+import unittest
+from deployFilter import DeployFilter
+
+ROOT = 'site_specific/SE'
+
+
+def makeFilter(default_rules, rules_files=None):
+	rules_files = rules_files or {}
+	return DeployFilter(rules_files.get, ROOT, default_rules=default_rules)
+
+
+class DeployFilterTest(unittest.TestCase):
+	def test_extension_at_any_depth(self):
+		deploy_filter = makeFilter(['*.pdf'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/a.pdf'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/app/docs/a.pdf'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/opt/app/a.pdf.txt'))
+
+	def test_anchored_dir(self):
+		deploy_filter = makeFilter(['/docs/'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/docs/a.txt'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/docs/sub/a.txt'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/opt/docs/a.txt'))
+		# Trailing / only matches dirs
+		self.assertFalse(makeFilter(['/docs/']).isExcluded(ROOT + '/docs'))
+
+	def test_unanchored_dir(self):
+		deploy_filter = makeFilter(['docs/'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/docs/a.txt'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/docs/a.txt'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/opt/docs'))
+
+	def test_pattern_with_slash_is_anchored(self):
+		deploy_filter = makeFilter(['opt/**/tmp'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/tmp'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/app/cache/tmp'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/app/tmp/a.txt'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/web/opt/tmp'))
+
+	def test_star_does_not_cross_dirs(self):
+		deploy_filter = makeFilter(['opt/*.log'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/a.log'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/opt/app/a.log'))
+
+	def test_negation_last_rule_wins(self):
+		deploy_filter = makeFilter(['*.pdf', '!keep.pdf'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/a.pdf'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/opt/keep.pdf'))
+
+	def test_nothing_under_excluded_dir_comes_back(self):
+		deploy_filter = makeFilter(['/docs/', '!keep.pdf'])
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/docs/keep.pdf'))
+
+	def test_rules_file_is_relative_to_its_dir(self):
+		deploy_filter = makeFilter([], {ROOT + '/opt/.deployignore': '/cache/\n*.bak\n'})
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/cache/a.txt'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/opt/app/cache/a.txt'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/app/a.bak'))
+		self.assertFalse(deploy_filter.isExcluded(ROOT + '/a.bak'))
+		self.assertTrue(deploy_filter.isExcluded(ROOT + '/opt/.deployignore'))
+
+	def test_paths_outside_the_site_dir(self):
+		deploy_filter = makeFilter(['*.pdf'])
+		self.assertFalse(deploy_filter.isExcluded('site_agnostic/a.pdf'))
+		self.assertFalse(deploy_filter.isExcluded('site_specific/WEST/a.pdf'))
+
+
+if __name__ == '__main__':
+	unittest.main()
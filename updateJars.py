@@ -14,6 +14,12 @@
 
 import os
 import shutil
+import argparse
+import logging
+from pprint import pprint
+from jarIndex import scanJarLocations, loadJarLocations, verifyJarManifest
+from copyEngine import FileCopier, PlacementExecutor
+from deployMetrics import Metrics, writeMetricsJson, writeMetricsTextfile, profiled
 
 #TODO: Update these global vars based on App VM, not local testcase
 LOCAL_GIT_DIR_PATH = '/test/aotx_azure'
@@ -21,49 +27,49 @@ LOCAL_GIT_JAR_DIR_PATH = LOCAL_GIT_DIR_PATH + '/site_specific/jars' #also contai
 ROOT_DIR = '/opt/app/p1c1w141'
 VERBOSE = True
 DRYRUN = True
+JAR_MANIFEST_PATH = 'jar_locations_manifest.json' # saved locations of every jar/war under ROOT_DIR, see jarIndex.py
+SKIP_UNCHANGED = True # don't rewrite destinations that already hold the same bytes, see copyEngine.py
+HASH_CACHE_PATH = 'file_hash_cache.json'
+PLACEMENT_STRATEGIES = ['reflink', 'copy_file_range', 'sendfile'] # add 'hardlink' to link every fanned out jar to one copy per filesystem, put 'delta' first for big files that change a little
+DELTA_MIN_SIZE = 8 * 1024 * 1024 # existing destinations at least this big only get their changed blocks written ('delta' strategy)
+COPY_WORKERS = 8 # threads used to place files on the app VM, see copyEngine.PlacementExecutor
+METRICS_JSON_PATH = 'update_jars_metrics.json' # time, files and bytes of the jar search and fan-out, see deployMetrics.py
+METRICS_TEXTFILE_PATH = None # same as a Prometheus textfile, i.e. '/var/lib/node_exporter/textfile_collector/update_jars.prom'
 
+metrics = Metrics()
 
-def findPathsToJar(filename, rootdir='.'):
-    # print(f'Grabbing all filepaths for {filename}')  # Press Ctrl+F8 to toggle the breakpoint.
-    # len_git_dir_path = len(LOCAL_GIT_DIR_PATH)
-    locations = []
-    for subdir, dirs, files in os.walk(rootdir):
-        for file in files:
-            bname = os.path.basename(file)
-            if bname == filename:
-                # TODO: remove the dirs used in CodeCloud but are not on server
-                fullpath = os.path.join(subdir, file)
-                locations.append(fullpath)
 
-    return locations
+def findPathsToJar(filename, rootdir='.'):
+    # TODO: remove the dirs used in CodeCloud but are not on server
+    return scanJarLocations([filename], rootdir=rootdir)[filename]
 
 
-def findPathsToAllJars(filenames, rootdir='.'):
+def findPathsToAllJars(filenames, rootdir='.', rescan=False):
     '''
     :param filenames: a list of jar filename strings. i.e. ['aotxweb.jar', 'xyz.war, 'cic.jar']
     :param rootdir: a string of the directory path to recursively search through
+    :param rescan: ignore the saved jar manifest and walk the whole rootdir again
     :return: a dictionary mapping the basefilename to a list of all the filepaths discovered in the rootdir.
     '''
+    # One walk of rootdir for every filename at once instead of one os.walk per jar. The result is saved in
+    # JAR_MANIFEST_PATH so later runs only re-scan the directories that changed since.
+    # TODO: Verify if we should ignore gitrepo dir when making replacements
+    # Skipping gitrepo dir during the walk b/c irrelevant to update these
+    return loadJarLocations(filenames, rootdir=rootdir, skipdirs=[LOCAL_GIT_DIR_PATH], manifest_path=JAR_MANIFEST_PATH, rescan=rescan)
 
-    len_git_dir_path = len(LOCAL_GIT_DIR_PATH)
-    relevant_filepaths = {}
-    for fname in filenames:
-        list_of_paths_to_fname = findPathsToJar(fname, rootdir=rootdir)
-        relevant_paths_to_fname = []
-        # TODO: Verify if we should ignore gitrepo dir when making replacements
-        # Filtering out gitrepo dir b/c irrelevant to update these
-        for apath in list_of_paths_to_fname:
-            if apath[0:len_git_dir_path] != LOCAL_GIT_DIR_PATH:
-                relevant_paths_to_fname.append(apath)
-        relevant_filepaths[fname] = relevant_paths_to_fname
-
-    return relevant_filepaths
-
-def replaceOldJARs(source_filepaths, rootdir='.', verbose=False, dryrun=False):
+def replaceOldJARs(source_filepaths, rootdir='.', verbose=False, dryrun=False, rescan=False, copier=None, executor=None):
+    '''
+    Copies each jar/war over every file of the same name under rootdir.
+    :param executor: PlacementExecutor to run the copies on, waited for before returning
+    :return: (jar filenames, dictionary mapping each filename to its destinations, list of (action, path, exception)
+        for the copies that failed)
+    '''
     filenames = []
     for fpath in source_filepaths:
         filenames.append(os.path.basename(fpath))
-    destination_filepaths = findPathsToAllJars(filenames, rootdir=rootdir)
+    with metrics.phase('jar_index'):
+        destination_filepaths = findPathsToAllJars(filenames, rootdir=rootdir, rescan=rescan)
+    metrics.record('jar_index', files=sum(len(dsts) for dsts in destination_filepaths.values()))
     for fname, fpath in zip(filenames, source_filepaths):
         src = fpath
         dest_fpaths = destination_filepaths[fname]
@@ -71,12 +77,25 @@ def replaceOldJARs(source_filepaths, rootdir='.', verbose=False, dryrun=False):
             if verbose:
                 print('src: {} | dst: {}'.format(src, dst))
             if dryrun is False:
-                newPath = shutil.copy(src, dst, follow_symlinks=False)
+                if executor is not None:
+                    executor.copy(src, dst, label='jar_fanout')
+                elif copier is not None:
+                    copier.copy(src, dst)
+                else:
+                    newPath = shutil.copy(src, dst, follow_symlinks=False)
+
+    if executor is not None:
+        with metrics.phase('jar_fanout_wait'):
+            failures = executor.wait()
+        for action, path, e in failures:
+            print('failed to {} {}: {}'.format(action, path, e))
+        if failures:
+            return filenames, destination_filepaths, failures
 
     if verbose:
         print("Successfully updated JARs")
 
-    return filenames, destination_filepaths
+    return filenames, destination_filepaths, []
 
 def getJarFilesFullSrcPaths(gitrepo_dir):
     jar_files_source_paths = []
@@ -89,7 +108,40 @@ def getJarFilesFullSrcPaths(gitrepo_dir):
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    jar_files_src_paths = getJarFilesFullSrcPaths(LOCAL_GIT_JAR_DIR_PATH)
-    # Setting verbose = True will print each pair of source and destination locations involved with the JAR updates
-    # Setting dryrun = True will do everything the same except the final step of actually copying the files over
-    jar_filenames, jar_dst_filepaths = replaceOldJARs(jar_files_src_paths, verbose=VERBOSE, dryrun=DRYRUN)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rescan', action='store_true', help='ignore the saved jar manifest and walk the whole root dir')
+    parser.add_argument('--verify', action='store_true', help='compare the saved jar manifest against the disk and exit')
+    parser.add_argument('--profile', metavar='PATH', help='run under cProfile and save the stats to PATH')
+    args = parser.parse_args()
+    # Each jar destination and the placement strategy used for it are logged at debug level
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('copyEngine').setLevel(logging.DEBUG if VERBOSE else logging.INFO)
+
+    if args.verify:
+        report = verifyJarManifest(JAR_MANIFEST_PATH, rootdir=ROOT_DIR)
+        if report is None:
+            print('No jar manifest at {}'.format(JAR_MANIFEST_PATH))
+        else:
+            pprint(report)
+        raise SystemExit(0 if report is not None and not report['missing'] and not report['unlisted'] else 1)
+
+    logging.getLogger('deployMetrics').setLevel(logging.INFO)
+    with profiled(args.profile):
+        copier = FileCopier(skip_unchanged=SKIP_UNCHANGED, hash_cache_path=HASH_CACHE_PATH, strategies=PLACEMENT_STRATEGIES, delta_min_size=DELTA_MIN_SIZE)
+        executor = PlacementExecutor(max_workers=COPY_WORKERS, copier=copier, metrics=metrics)
+        jar_files_src_paths = getJarFilesFullSrcPaths(LOCAL_GIT_JAR_DIR_PATH)
+        # Setting verbose = True will print each pair of source and destination locations involved with the JAR updates
+        # Setting dryrun = True will do everything the same except the final step of actually copying the files over
+        jar_filenames, jar_dst_filepaths, failures = replaceOldJARs(jar_files_src_paths, verbose=VERBOSE, dryrun=DRYRUN, rescan=args.rescan, executor=executor)
+        executor.shutdown()
+    print(copier.report())
+    copier.save()
+    metrics.ok = not failures
+    print(metrics.report())
+    if METRICS_JSON_PATH:
+        writeMetricsJson(METRICS_JSON_PATH, {'update_jars': metrics.toDict()})
+    if METRICS_TEXTFILE_PATH:
+        writeMetricsTextfile(METRICS_TEXTFILE_PATH, {'update_jars': metrics.toDict()}, prefix='update_jars')
+    if failures:
+        print('{} jar/war copies failed'.format(len(failures)))
+    raise SystemExit(0 if not failures else 1)